@@ -1,21 +1,37 @@
+import asyncio
+import functools
+
 import gradio as gr
 
-from md2tex import md_to_tex
+from md2tex import Config, IncrementalConverter, get_converter
+from service import ConversionService, ServiceBusy
+
+# 转换在独立的进程池中进行，大文档不会阻塞其他用户
+service = ConversionService(queue_size=32, timeout=60.0)
 
-class Args:
-    def __init__(self, figure_pos, table_pos, spaces, code_type, have_title):
-        self.figure_pos = figure_pos
-        self.table_pos = table_pos
-        self.spaces = spaces
-        self.code_type = code_type
-        self.have_title = have_title
+@functools.lru_cache(maxsize=8)
+def get_incremental_converter(config):
+    return IncrementalConverter(get_converter(config))
 
-def md_to_tex_wrapper(content, figure_pos, table_pos, spaces, code_type, have_title):
+def make_config(figure_pos, table_pos, spaces, code_type, have_title):
     # 将figure_pos和table_pos的列表转换为字符串
-    figure_pos = "".join(figure_pos)
-    table_pos = "".join(table_pos)
-    args = Args(figure_pos, table_pos, spaces, code_type, have_title)
-    return md_to_tex(content, args)
+    return Config("".join(figure_pos), "".join(table_pos), int(spaces), code_type, have_title)
+
+async def md_to_tex_wrapper(content, figure_pos, table_pos, spaces, code_type, have_title):
+    config = make_config(figure_pos, table_pos, spaces, code_type, have_title)
+    try:
+        return await service.convert(content, config)
+    except ServiceBusy:
+        raise gr.Error("Too many conversions are running, please try again later.")
+    except asyncio.TimeoutError:
+        raise gr.Error("The conversion timed out.")
+
+def live_preview(content, live, figure_pos, table_pos, spaces, code_type, have_title):
+    if not live:
+        return gr.update()
+    # 实时预览只重新转换修改过的段落，直接在本进程中完成
+    config = make_config(figure_pos, table_pos, spaces, code_type, have_title)
+    return get_incremental_converter(config).convert(content)
 
 with gr.Blocks(theme=gr.themes.Soft(font="system-ui")) as demo:
     gr.Markdown("## Markdown to LaTeX Converter")
@@ -23,7 +39,9 @@ with gr.Blocks(theme=gr.themes.Soft(font="system-ui")) as demo:
     with gr.Row():
         with gr.Column():
             markdown_input = gr.Textbox(lines=10, label="Markdown Input", placeholder="Enter markdown here...")
-            submit_button = gr.Button("Convert", variant="primary")
+            with gr.Row():
+                live = gr.Checkbox(label="Live Preview", value=False, info="Convert while typing")
+                submit_button = gr.Button("Convert", variant="primary")
         with gr.Column():
             output = gr.Textbox(label="LaTeX Output", lines=12.6, max_lines=22.6, interactive=False, placeholder="LaTeX output will appear here...", show_copy_button=True)
 
@@ -35,6 +53,7 @@ with gr.Blocks(theme=gr.themes.Soft(font="system-ui")) as demo:
         have_title = gr.Checkbox(label="Have Title", value=False, info="Whether the document has a title, if Ture, ‘#’ will not be translated and ‘##’ will translated into ‘\section’, else ‘#’ will be translated into ‘\section’.")
 
     submit_button.click(md_to_tex_wrapper, inputs=[markdown_input, figure_pos, table_pos, spaces, code_type, have_title], outputs=output, show_progress=True)
+    markdown_input.change(live_preview, inputs=[markdown_input, live, figure_pos, table_pos, spaces, code_type, have_title], outputs=output, show_progress="hidden", trigger_mode="always_last")
 
 if __name__ == "__main__":
     demo.launch()
\ No newline at end of file
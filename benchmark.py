@@ -0,0 +1,287 @@
+"""Conversion speed benchmark for md2tex.
+
+Generates synthetic markdown documents built from the constructs of demo/example.md,
+in several mixes and sizes, and times the whole conversion as well as each stage:
+
+    blocks     splitting the document into blocks
+    tables     render_table on every table block
+    equations  render_equation on every $$ block
+    lines      the per-line loop over the already rendered blocks
+
+Throughput is reported in lines/s and MB/s, together with the peak memory of one
+conversion (tracemalloc). Results can be saved as JSON and compared against a saved
+baseline; any stage slower than the baseline by more than --tolerance fails the run:
+
+    python benchmark.py --json baseline.json
+    python benchmark.py --baseline baseline.json
+    python benchmark.py --mixes tables equations --sizes 1000 10000 50000
+
+--fragments N additionally measures the cost per fragment of converting N short
+documents with md_to_tex one by one, and with convert_batch in this process and on
+--jobs processes:
+
+    python benchmark.py --sizes --fragments 10000 --jobs 4
+
+--daemon N times N conversions of a small file by a new `python md2tex.py` process each,
+by md2tex_client.py with and without a running daemon (python md2tex.py --serve), and
+by requests on one open connection to the daemon, like an editor plugin would send:
+
+    python benchmark.py --sizes --daemon 50
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import md2tex_client
+from md2tex import Block, Config, block, convert_batch, env, get_converter, iter_blocks, md_to_tex, render_equation, render_table
+
+WORDS = ['这是一段正常的文字', 'alpha', '中文内容', 'beta', '100%', 'gamma', '结果']
+
+def heading(r, n):
+    return [r.choice(['##', '###', '####']) + f' 第{n}节', '']
+
+def paragraph(r, n):
+    return [f'{r.choice(WORDS)}，**这里是粗体**，*这里是斜体*，行内代码`print("Hello World")`，'
+            f'超链接[Cleversmall](https://www.cleversmall.com)，文献[@name2024paper]，图[#fig{n}]所示。', '']
+
+def inline_math(r, n):
+    spans = ' '.join(f'${r.choice("abcxyz")}_{i}^2+{r.randint(0, 9)}$，*变量*' for i in range(r.randint(10, 40)))
+    return [f'公式{n}：' + spans, '']
+
+def table(r, n):
+    lines = [f'*==tab{n}_测试表格==*', '', '|    标题1 | 这里居中对齐 | 标题2    |', '| -------: | :----------: | :------- |']
+    for i in range(r.randint(2, 30)):
+        lines.append(f'| 右对齐{i} |    **内容{i}**    | $x_{i}$ |')
+    return lines + ['']
+
+def equation(r, n):
+    if r.random() < .5:
+        return [f'*==eq:{n}==*', '', '$$', '\\begin{bmatrix}', 'a & b \\\\ c & d', '\\end{bmatrix}',
+                '\\neq', '\\begin{matrix}', 'e & f \\\\ g & h', '\\end{matrix}', '$$', '']
+    return ['$$', 'a<b, c>d, e\\in (0,1)', '$$', '']
+
+def items(r, n):
+    if r.random() < .5:
+        return [f'- 项目{i} *{r.choice(WORDS)}*' for i in range(r.randint(2, 8))] + ['']
+    return [f'{i + 1}. 内容{i} $x_{i}$' for i in range(r.randint(2, 8))] + ['']
+
+def image(r, n):
+    return [r.choice([f'<img src="./figure/latex_bird.png" alt="fig{n}" style="zoom: 50%;" />',
+                      f'<img src="./figure/latex_bird.png" title="图{n}" />',
+                      f'![fig{n}](./figure/latex_bird.png "图{n}")',
+                      f'可以使用<u> 下划线文本 </u>与<font color=Red> 红色文本 </font>，其中 $x<y$ 不会被误判。']), '']
+
+def code(r, n):
+    return ['```python', 'import numpy', '', f'print("Hello World {n}")', '```', '']
+
+# 每种文档类型中各结构出现的权重
+MIXES = {
+    'mixed': {heading: 1, paragraph: 3, inline_math: 1, table: 1, equation: 1, items: 1, image: 1, code: 1},
+    'tables': {heading: 1, paragraph: 1, table: 6},
+    'equations': {heading: 1, paragraph: 1, equation: 6},
+    'lists': {heading: 1, paragraph: 1, items: 6},
+    'inline-math': {heading: 1, inline_math: 6},
+    'images': {heading: 1, paragraph: 1, image: 6},
+}
+
+CONFIG = Config()
+
+def make_document(lines, mix='mixed', seed=0):
+    """Build a deterministic document of about the given number of lines from one mix."""
+    r = random.Random(seed)
+    weights = MIXES[mix]
+    constructs, cum = list(weights), list(weights.values())
+    out = []
+    n = 0
+    while len(out) < lines:
+        out += r.choices(constructs, cum)[0](r, n)
+        n += 1
+    return '\n'.join(out) + '\n'
+
+def rendered_blocks(blocks):
+    """Render tables and equations in advance, so the line loop can be timed on its own."""
+    out = []
+    for blk in blocks:
+        if blk.kind == block.table:
+            blk = Block(block.paragraph, list(render_table(blk, CONFIG)), blk.lineno)
+        elif blk.kind == block.equation:
+            blk = Block(block.paragraph, render_equation(blk, CONFIG), blk.lineno)
+        out.append(blk)
+    return out
+
+def stages(content):
+    """Return {stage: callable} for one document."""
+    converter = get_converter(CONFIG)
+    lines = content.split('\n')
+    blocks = list(iter_blocks(lines))
+    tables = [blk for blk in blocks if blk.kind == block.table]
+    equations = [blk for blk in blocks if blk.kind == block.equation]
+    rendered = rendered_blocks(blocks)
+    level1 = converter.start(lines)[0]
+
+    def line_loop():
+        for _ in converter.convert_blocks(iter(rendered), level1, [env.document], ''):
+            pass
+
+    return {
+        'total': lambda: converter.convert(content),
+        'blocks': lambda: list(iter_blocks(lines)),
+        'tables': lambda: [list(render_table(blk, CONFIG)) for blk in tables],
+        'equations': lambda: [render_equation(blk, CONFIG) for blk in equations],
+        'lines': line_loop,
+    }
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(mixes, sizes, repeat):
+    results = []
+    print(f'{"mix":<12} {"lines":>8} {"seconds":>9} {"lines/s":>10} {"MB/s":>7} {"peak MB":>8} '
+          f'{"blocks":>8} {"tables":>8} {"equations":>9} {"lines":>8}')
+    for mix in mixes:
+        for size in sizes:
+            content = make_document(size, mix)
+            n_lines = content.count('\n')
+            n_bytes = len(content.encode('utf-8'))
+            funcs = stages(content)
+            times = {name: best_of(repeat, func) for name, func in funcs.items()}
+            peak = peak_memory(funcs['total'])
+            total = times['total']
+            results.append({'mix': mix, 'lines': n_lines, 'bytes': n_bytes, 'seconds': times,
+                            'lines_per_s': n_lines / total, 'mb_per_s': n_bytes / total / 1e6, 'peak_bytes': peak})
+            print(f'{mix:<12} {n_lines:>8} {total:>9.3f} {n_lines / total:>10.0f} {n_bytes / total / 1e6:>7.2f} {peak / 1e6:>8.2f} '
+                  f'{times["blocks"]:>8.3f} {times["tables"]:>8.3f} {times["equations"]:>9.3f} {times["lines"]:>8.3f}')
+    return results
+
+def make_fragments(count, seed=0):
+    """Short documents of one to a few constructs, like generated exercise solutions."""
+    r = random.Random(seed)
+    constructs = [paragraph, inline_math, items, equation, table, heading]
+    return ['\n'.join(line for construct in r.choices(constructs, k=r.randint(1, 3)) for line in construct(r, i))
+            for i in range(count)]
+
+def fragment_overhead(count, jobs, repeat):
+    fragments = make_fragments(count)
+    args = argparse.Namespace(**vars(CONFIG))
+    expected = [md_to_tex(fragment, args) for fragment in fragments]
+    runs = [('md_to_tex per call', lambda: [md_to_tex(fragment, args) for fragment in fragments]),
+            ('convert_batch', lambda: convert_batch(fragments, args))]
+    if jobs > 1:
+        runs.append((f'convert_batch {jobs} processes', lambda: convert_batch(fragments, args, jobs)))
+    print(f'{"fragments":<32} {"seconds":>9} {"us/fragment":>12}')
+    results = {}
+    for name, func in runs:
+        assert func() == expected, name
+        seconds = best_of(repeat, func)
+        results[name] = seconds
+        print(f'{name:<32} {seconds:>9.3f} {seconds / count * 1e6:>12.1f}')
+    return results
+
+def daemon_latency(calls, repeat):
+    here = os.path.dirname(os.path.abspath(__file__))
+    script, client = os.path.join(here, 'md2tex.py'), os.path.join(here, 'md2tex_client.py')
+    markdown = make_document(20, 'mixed')
+    expected = get_converter(CONFIG).convert(markdown)
+    with tempfile.TemporaryDirectory() as tmp:
+        md_file, tex_file, sock_path = (os.path.join(tmp, name) for name in ('small.md', 'small.tex', 'md2tex.sock'))
+        with open(md_file, 'w', encoding='utf-8') as f:
+            f.write(markdown)
+
+        def run(*command):
+            return lambda: [subprocess.run(command, check=True, stdout=subprocess.DEVNULL) for _ in range(calls)]
+
+        results = {}
+
+        def timed(name, func):
+            seconds = results[name] = best_of(repeat, func)
+            print(f'{name:<32} {seconds:>9.3f} {seconds / calls * 1000:>9.3f}')
+
+        print(f'{"small file (20 lines)":<32} {"seconds":>9} {"ms/call":>9}')
+        timed('python md2tex.py', run(sys.executable, script, '--md-file', md_file, '--tex-file', tex_file, '-o', '--no-cache'))
+        # 守护进程启动之前，客户端退回到本进程内转换
+        timed('client, no daemon', run(sys.executable, client, '--md-file', md_file, '--tex-file', tex_file, '--socket', sock_path))
+        daemon = subprocess.Popen([sys.executable, script, '--serve', sock_path], stdout=subprocess.DEVNULL)
+        try:
+            while md2tex_client.connect(sock_path) is None:
+                time.sleep(0.05)
+            timed('client, daemon', run(sys.executable, client, '--md-file', md_file, '--tex-file', tex_file, '--socket', sock_path))
+            with md2tex_client.connect(sock_path) as sock:
+                assert ''.join(md2tex_client.request(sock, markdown)) == expected
+                timed('daemon, open connection', lambda: [''.join(md2tex_client.request(sock, markdown)) for _ in range(calls)])
+            timed('in process', lambda: [get_converter(CONFIG).convert(markdown) for _ in range(calls)])
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    return results
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Print every stage that got slower (or used more memory) than the baseline; returns the count."""
+    old = {(r['mix'], r['lines']): r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        b = old.get((r['mix'], r['lines']))
+        if b is None:
+            continue
+        checks = [(f'{stage} time', r['seconds'][stage], b['seconds'][stage]) for stage in r['seconds']
+                  if stage in b['seconds'] and b['seconds'][stage] >= min_seconds]
+        checks.append(('peak memory', r['peak_bytes'], b['peak_bytes']))
+        for name, new, ref in checks:
+            if ref and new > ref * (1 + tolerance):
+                regressions += 1
+                print(f'REGRESSION {r["mix"]}/{r["lines"]} {name}: {ref:.4g} -> {new:.4g} (+{(new / ref - 1) * 100:.0f}%)')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark md2tex conversion speed')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 5000, 20000], help='Document sizes in lines')
+    parser.add_argument('--mixes', nargs='+', choices=list(MIXES), default=list(MIXES), help='Document mixes to run')
+    parser.add_argument('--repeat', type=int, default=5, help='Best of N runs')
+    parser.add_argument('--json', type=str, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, help='Compare against a JSON file written by --json')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--min-seconds', type=float, default=0.005, help='Ignore stages faster than this in the baseline (too noisy)')
+    parser.add_argument('--fragments', type=int, default=0, help='Also time converting this many short fragments')
+    parser.add_argument('--jobs', type=int, default=1, help='Processes for the fragment batch')
+    parser.add_argument('--daemon', type=int, default=0, help='Also time this many small conversions with and without the daemon')
+    args = parser.parse_args()
+
+    results = run(args.mixes, args.sizes, args.repeat) if args.sizes else []
+    if args.fragments:
+        fragment_overhead(args.fragments, args.jobs, args.repeat)
+    if args.daemon:
+        daemon_latency(args.daemon, args.repeat)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            print(f'{regressions} regression(s) against {args.baseline}')
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
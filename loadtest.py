@@ -0,0 +1,93 @@
+"""Load test for the md2tex conversion service.
+
+Starts the service with its HTTP/JSON endpoint in this process (or targets a running one
+with --port and --external), then sends requests from a growing number of concurrent
+clients and reports throughput and latency percentiles per concurrency level:
+
+    python loadtest.py --workers 4 --concurrency 1 4 16 64 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from benchmark import make_document
+from service import ConversionService, serve
+
+async def post(reader, writer, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(b'POST /convert HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 + f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+async def client(host, port, documents, count, latencies, statuses):
+    """One keep-alive connection sending count requests back to back."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            status = await post(reader, writer, {'markdown': random.choice(documents)})
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] if len(values) > 1 else values[0]
+
+async def run(args):
+    service = server = None
+    if not args.external:
+        service = ConversionService(args.workers, args.queue_size, args.timeout)
+        server = await serve(service, args.host, args.port)
+    # 大小不一的文档，模拟不同用户的请求
+    documents = [make_document(size, mix) for size in args.sizes for mix in ('mixed', 'tables', 'inline-math')]
+
+    print(f'{"clients":>8} {"requests":>9} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}  status')
+    try:
+        for concurrency in args.concurrency:
+            latencies, statuses = [], {}
+            per_client = max(1, args.requests // concurrency)
+            start = time.perf_counter()
+            await asyncio.gather(*(client(args.host, args.port, documents, per_client, latencies, statuses)
+                                   for _ in range(concurrency)))
+            wall = time.perf_counter() - start
+            ms = [latency * 1000 for latency in latencies]
+            print(f'{concurrency:>8} {len(ms):>9} {len(ms) / wall:>8.1f} {percentile(ms, 50):>8.1f} {percentile(ms, 95):>8.1f} '
+                  f'{percentile(ms, 99):>8.1f} {max(ms):>8.1f}  {dict(sorted(statuses.items()))}')
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            await service.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the md2tex conversion service')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Service address')
+    parser.add_argument('--port', type=int, default=8766, help='Service port')
+    parser.add_argument('--external', action='store_true', help='Use an already running service instead of starting one')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes of the started service')
+    parser.add_argument('--queue-size', type=int, default=64, help='Queue size of the started service')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Request timeout of the started service')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per concurrency level')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000], help='Document sizes in lines')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,25 @@
 import argparse
+import copy
+import functools
+import glob
+import hashlib
 import html.parser as parser
+import itertools
+import json
 import os
 import re
+import shutil
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
 import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields
 from enum import Enum, auto
 
 
@@ -20,165 +37,157 @@ WARN = '\033[0;37;43mWarning\033[0m '
 ERROR = '\033[0;37;41mError\033[0m '
 
 class MdHtmlParser(parser.HTMLParser):
-    """Tiny HTML start tag collector (only first tag is kept)."""
+    """Tiny HTML start tag collector; tag/attrs hold the first tag, tags all of them."""
     def __init__(self):
         super().__init__()
         self.tag = None
         self.attrs = None
+        self.tags = []
     def handle_starttag(self, tag, attrs):
-        if self.tag is None:  # only record the first for efficiency
+        if self.tag is None:
             self.tag = tag
             self.attrs = dict(attrs)
+        self.tags.append((self.get_starttag_text(), tag, dict(attrs)))
+
+# 简单的开始标签和属性，可以不经过HTMLParser直接解析
+HTML_START_TAG_PATTERN = re.compile(
+    r'<([a-zA-Z][-a-zA-Z0-9]*)((?:[ \t\n\r\f]+[a-zA-Z_:][-a-zA-Z0-9_:.]*'
+    r'(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'=<>`]+))?)*)[ \t\n\r\f]*/?>')
+HTML_ATTR_PATTERN = re.compile(r'([a-zA-Z_:][-a-zA-Z0-9_:.]*)(\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+)))?')
+HTML_TEXT_PATTERN = re.compile(r'(?:[^<]|</[a-zA-Z][^<>]*>)*')
+
+def parse_html_tags(line):
+    """Return (tag text, tag, attrs) for every start tag in line.
+
+    Plain tags are read with precompiled patterns. Lines the patterns cannot read exactly
+    like html.parser would (entities, comments, a '<' that starts no plain tag, raw text
+    elements) go through MdHtmlParser instead.
+    """
+    if '&' not in line and '<!' not in line:
+        tags = []
+        pos = 0
+        for m in HTML_START_TAG_PATTERN.finditer(line):
+            if not HTML_TEXT_PATTERN.fullmatch(line, pos, m.start()):
+                break
+            tag = m.group(1).lower()
+            if tag in ('script', 'style'):
+                break
+            attrs = {}
+            for attr in HTML_ATTR_PATTERN.finditer(m.group(2)):
+                # 没有值的属性与HTMLParser一样记为None
+                value = None if attr.group(2) is None else next(v for v in attr.group(3, 4, 5) if v is not None)
+                attrs[attr.group(1).lower()] = value
+            tags.append((m.group(0), tag, attrs))
+            pos = m.end()
+        else:
+            if HTML_TEXT_PATTERN.fullmatch(line, pos):
+                return tags
+    html_parser = MdHtmlParser()
+    html_parser.feed(line)
+    return html_parser.tags
 
 KNOWN_INLINE_HTML_TAGS = {
     'img', 'a', 'br', 'hr', 'span', 'strong', 'em', 'code', 'u', 'font'
 }
 
 MATH_INLINE_PATTERN = re.compile(r'\$(?:[^$\\]|\\.)+\$')  # $...$ with simple escaping
+CODE_INLINE_PATTERN = re.compile(r'`[^`]+`')
+HTML_TAG_PATTERN = re.compile(r'<\s*([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>')
 
-def _mask_segments(pattern, text, placeholder_prefix):
-    """Mask segments matched by pattern to protect them from downstream regex replacements.
-    Returns masked_text, list of (placeholder, original_text)."""
-    replacements = []
-    def repl(match):
-        placeholder = f'__{placeholder_prefix}{len(replacements)}__'
-        replacements.append((placeholder, match.group(0)))
-        return placeholder
-    masked = pattern.sub(repl, text)
-    return masked, replacements
+# 行内公式和代码一次扫描完成，谁先出现谁优先
+INLINE_SPAN_PATTERN = re.compile(f'{MATH_INLINE_PATTERN.pattern}|{CODE_INLINE_PATTERN.pattern}')
 
-def _unmask(text, replacements):
-    for placeholder, original in replacements:
-        text = text.replace(placeholder, original)
-    return text
+def _sentinel(line):
+    """A character that does not occur in line, used to delimit placeholders."""
+    if '\x00' not in line:
+        return '\x00'
+    sentinel = '\ue000'
+    while sentinel in line:
+        sentinel = chr(ord(sentinel) + 1)
+    return sentinel
 
 def mask_math_and_code(line):
-    """Mask inline math $...$ and code `...` blocks to avoid accidental formatting or HTML detection."""
-    masked, math_repls = _mask_segments(MATH_INLINE_PATTERN, line, 'MATH')
-    code_pattern = re.compile(r'`[^`]+`')
-    masked, code_repls = _mask_segments(code_pattern, masked, 'CODE')
-    return masked, math_repls + code_repls
+    """Mask inline math $...$ and code `...` spans to avoid accidental formatting or HTML detection.
+    Span i is replaced by sentinel + str(i) + sentinel, where the sentinel never occurs in line.
+    Returns masked_text, (sentinel, list of original spans)."""
+    segments = []
+    sentinel = _sentinel(line)
+    def repl(match):
+        segments.append(match.group(0))
+        return f'{sentinel}{len(segments) - 1}{sentinel}'
+    masked = INLINE_SPAN_PATTERN.sub(repl, line)
+    return masked, (sentinel, segments)
+
+def _unmask(text, replacements):
+    sentinel, segments = replacements
+    if not segments:
+        return text
+    # 拆分后奇数位置都是占位符的序号
+    parts = text.split(sentinel)
+    parts[1::2] = [segments[int(i)] for i in parts[1::2]]
+    return ''.join(parts)
 
 def has_html(line):
-    """More conservative HTML detection that ignores content inside math/code placeholders.
+    """More conservative HTML detection that ignores content inside math/code spans.
     We only consider as HTML if a known tag begins with <tag ...> or <tag>.
     Angle brackets in math like $a<b$ or vector notation <x,y> will NOT be treated as HTML.
     """
     if '<' not in line or '>' not in line:
         return False
-    # Quick reject: ignore placeholders
-    tmp = line
     # Recognize minimal pattern: <tag ...>
-    candidate_tags = re.findall(r'<\s*([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>', tmp)
-    for t in candidate_tags:
-        if t.lower() in KNOWN_INLINE_HTML_TAGS:
-            return True
-    return False
+    return any(m.group(1).lower() in KNOWN_INLINE_HTML_TAGS for m in HTML_TAG_PATTERN.finditer(line))
 
 def arg_parser():
     parser = argparse.ArgumentParser(description='Convert markdown to latex')
-    parser.add_argument('--md-file', type=str, default='report.md', help='The markdown file to be converted')
-    parser.add_argument('--tex-file', type=str, help='The output tex file')
+    parser.add_argument('--md-file', type=str, default='report.md',
+                        help='The markdown file to be converted, or a directory / glob pattern for batch conversion')
+    parser.add_argument('--tex-file', type=str, help='The output tex file (output directory in batch mode)')
     parser.add_argument('--template', type=str, help='The template tex file')
     parser.add_argument('--figure-pos', type=str, default='ht', help='The position of the figure')
     parser.add_argument('--table-pos', type=str, default='ht', help='The position of the table')
-    parser.add_argument('-o', action='store_true', help='Overwrite the existing tex file')
+    parser.add_argument('-o', action='store_true', help='Overwrite the existing tex file (same as --suffix-policy overwrite)')
+    parser.add_argument('--suffix-policy', choices=SUFFIX_POLICIES, default='increment',
+                        help='What to do when the tex file exists: add a " (n)" suffix, overwrite it, or stop with an error')
     parser.add_argument('-v', action='store_true', help='Use VLOOK style cross-reference, else pandoc style')
     parser.add_argument("--spaces", type=int, default=4, help="Number of spaces for each indentation level")
     parser.add_argument("--code-type", type=str, default="minted", help="How to handle code text")
+    parser.add_argument('--longtable-rows', type=int, default=500,
+                        help='Tables with more body rows become a longtable (needs \\usepackage{longtable}); 0 never does')
+    parser.add_argument('--cache-dir', type=str,
+                        default=os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'md2tex'),
+                        help='Directory of the conversion cache')
+    parser.add_argument('--cache-size', type=int, default=256, help='Maximum size of the conversion cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Always convert, without reading or writing the cache')
+    parser.add_argument('--block-memo-size', type=int, default=4096,
+                        help='Rendered tables and equations kept in memory for reuse (also shared on disk in the cache directory)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes in batch mode, or with --split')
+    parser.add_argument('--split', action='store_true',
+                        help='Split a single markdown file into parts converted by --jobs processes; '
+                             'the whole file and its output are held in memory and the block memo is not used')
+    parser.add_argument('--watch', action='store_true', help='Keep running and re-convert whenever the markdown files or the template change')
+    parser.add_argument('--watch-interval', type=float, default=0.5, help='Seconds between two polls in watch mode')
+    parser.add_argument('--profile', nargs='?', const='', metavar='JSON',
+                        help='Print calls, matches and time of every conversion stage and inline rule, or write them to a JSON file')
+    parser.add_argument('--xref', nargs='?', const='', metavar='JSON',
+                        help='Index labels, references and citations, report broken ones and write the index next to the tex file (or to JSON)')
+    parser.add_argument('--bib', type=str, nargs='+', metavar='BIB', help='Check citations against these .bib files (with --xref)')
+    parser.add_argument('--assets', nargs='?', const='', metavar='JSON',
+                        help='Check every image (missing, unsupported or oversized) and write a manifest next to the tex file (or to JSON)')
+    parser.add_argument('--rewrite-images', action='store_true',
+                        help='Rewrite image paths relative to the directory of the tex file instead of the markdown file')
+    parser.add_argument('--serve', nargs='?', const='', metavar='SOCKET',
+                        help='Run as a daemon converting requests from md2tex_client.py on a Unix socket (default: md2tex.sock in $XDG_RUNTIME_DIR)')
+    parser.add_argument('--debounce', type=float, default=0.3, help='Seconds the files must stay unchanged before converting in watch mode')
     parser.add_argument(
         "-have-title",
         action="store_true",
         help=("Whether the document has a title; if True, '#' remains plain and '##' becomes \\section; "
               "otherwise '#' becomes \\section."),
     )
-    return parser.parse_args()
-
-# 将markdown中的表格转换为latex格式
-def tables_convert(tables, with_caption, args):
-    def replace_func(match):
-        s = match.group(0).strip()
-        if s.isspace():
-            return r'\textbf{}'
-        else:
-            return r'\textbf{' + s + '}'
-
-    ret_tables = []
-    indent = ' ' * args.spaces  # 获取动态缩进
-    for table in tables:
-        label, caption = None, None
-        table = table[0].split('\n')
-        if with_caption:
-            label_caption = table[0]
-            for i in range(1, len(table) - 1):
-                if table[i] == '':
-                    i +=1
-                else:
-                    break
-            header = table[i]
-            alignment = table[i + 1]
-            body = table[i + 2:]
-        else:
-            header = table[0]
-            alignment = table[1]
-            body = table[2:]
-
-        if with_caption:
-            label_caption = re.findall(r'\*==(.*?)==\*', label_caption)[0]
-            # 如果有下划线，则分别为label和caption，否则只有caption
-            if '_' in label_caption:
-                label, caption = label_caption.split('_')
-            else:
-                label = None
-                caption = label_caption
-        
-        if caption:
-            ret_table = (
-                f"\\begin{{table}}[" + args.table_pos + f"]\n"
-                f"{indent}\\centering\n"
-                f"{indent}\\caption{{{caption}}}\n"
-                f"{indent}\\begin{{tabular}}" + '{'
-            )
-        else:
-            ret_table = (
-                f"\\begin{{table}}[" + args.table_pos + f"]\n"
-                f"{indent}\\centering\n"
-                f"{indent}\\begin{{tabular}}" + '{'
-            )
-        aligns = re.findall(r':?-+:?|:-+|-+:', alignment)
-        for align in aligns:
-            if align.startswith(':') and align.endswith(':'):
-                ret_table += 'c'
-            elif align.endswith(':'):
-                ret_table += 'r'
-            else:
-                ret_table += 'l'
-        ret_table += f'}}\n{indent}{indent}\\toprule\n'
-        # change the header to bold
-        ret_header = re.sub(r'^\||\|$', '', re.sub(r'\|', ' & ', header))
-        ret_header = re.sub(r'^\s*&|&\s*$', '', re.sub(r'\|', ' & ', header))
-        ret_header = re.sub(r'[^&]+', replace_func, ret_header)
-        ret_table += '        ' + ret_header + ' \\\\\n        \\midrule\n'
-        for i in range(len(body) - 1):
-            ret_body = re.sub(r'^\||\|$', '', re.sub(r'\|', ' & ', body[i]))
-            ret_body = re.sub(r'^\s*&|&\s*$', '', re.sub(r'\|', ' & ', body[i]))
-            # ret_body = re.sub(r'[^&]+', replace_func, ret_body)
-            ret_table += f'{indent}{indent}' + ret_body + ' \\\\\n'
-        if label:
-            ret_table += (
-                f"{indent}{indent}\\bottomrule\n"
-                f"{indent}\\end{{tabular}}\n"
-                f"{indent}\\label{{{label}}}\n"
-                f"\\end{{table}}\n"
-            )
-        else:
-            ret_table += (
-                f"{indent}{indent}\\bottomrule\n"
-                f"{indent}\\end{{tabular}}\n"
-                f"\\end{{table}}\n"
-            )
-        ret_tables.append(ret_table)
-    return ret_tables
+    args = parser.parse_args()
+    if args.o:
+        args.suffix_policy = 'overwrite'
+    return args
 
 def equations_convert(equations, with_caption, args):
     ret_eqs = []
@@ -205,336 +214,1956 @@ def equations_convert(equations, with_caption, args):
         ret_eqs.append(ret_eq)
     return ret_eqs
 
-def md_to_tex(md_content, args):
-    indent = ' ' * args.spaces  # 获取动态缩进
-    have_title = args.have_title
-
-    # 提取带标题的表格内容
-    table_label_pattern = re.compile(r"(\*==(.+?)==\*\n+\|.*?\|\n(\|.*?\|\n)+(\|.*?\|\n)*)", re.DOTALL)
-    tables = table_label_pattern.findall(md_content)
-    if tables:
-        tex_tables = tables_convert(tables, True, args)
-        for i in range(len(tables)):
-            md_content = md_content.replace(tables[i][0], tex_tables[i])
-    
-    # 提取不带标题的表格内容
-    table_pattern = re.compile(r"(\|.*?\|\n(\|.*?\|\n)+(\|.*?\|\n)*)", re.DOTALL)
-    tables = table_pattern.findall(md_content)
-    if tables:
-        tex_tables = tables_convert(tables, False, args)
-        for i in range(len(tables)):
-            md_content = md_content.replace(tables[i][0], tex_tables[i])
-    
-    # 提取带标题的公式内容
-    equation_label_pattern = re.compile(r"(\*==(.+?)==\*\n+\$\$(.+?)\$\$)", re.DOTALL)
-    equations = equation_label_pattern.findall(md_content)
-    if equations:
-        tex_equations = equations_convert(equations, True, args)
-        for i in range(len(equations)):
-            md_content = md_content.replace(equations[i][0], tex_equations[i])
-        
-    # 提取不带标题的公式内容
-    equation_pattern = re.compile(r"(\$\$(.+?)\$\$)", re.DOTALL)
-    equations = equation_pattern.findall(md_content)
-    if equations:
-        tex_equations = equations_convert(equations, False, args)
-        for i in range(len(equations)):
-            md_content = md_content.replace(equations[i][0], tex_equations[i])
-    
-    # 检测是否有一级标题存在
-    if re.match(r'^#\s', md_content):
-        level1 = True
+# 按块拆分markdown
+class block(Enum):
+    blank = auto()
+    heading = auto()
+    paragraph = auto()
+    list_item = auto()
+    html = auto()
+    table = auto()
+    equation = auto()
+    code = auto()
+
+Block = namedtuple('Block', ['kind', 'lines', 'lineno'])
+
+CAPTION_PATTERN = re.compile(r'^\*==(.+?)==\*$')
+TITLE_PATTERN = re.compile(r'^#\s.*\n*')
+FENCE_PATTERN = re.compile(r'^\s*```')
+LIST_NUM_PATTERN = re.compile(r'^\s*\d+\.\s+')
+
+def _is_table_line(line):
+    return len(line) > 1 and line[0] == '|' and line[-1] == '|'
+
+def _line_block(lineno, line):
+    if line == '':
+        kind = block.blank
+    elif line[0] == '#':
+        kind = block.heading
+    elif line.startswith('- ') or LIST_NUM_PATTERN.match(line):
+        kind = block.list_item
+    elif '<' in line:
+        kind = block.html
     else:
-        level1 = False
-    
-    if have_title:
-        level1 = False
-    
-    if level1 == False:
-        # 删除所有一级标题，将#以及后续文字及换行符删除
-        md_content = re.sub(r'^#\s.*\n*', '', md_content)
-
-    # 将md_content按行分割
-    md_content = md_content.split('\n')
-    tex_content = ''
-    env_stack = []
-    env_stack.append(env.document)
-    align_flag = False
-
-    md_index = -1
-    for md_line in md_content:
-        tex_line = md_line
-        md_index += 1
-
-        # 处理空行
-        if md_line == '': 
-            tex_content += '\n'
+        kind = block.paragraph
+    return Block(kind, [line], lineno)
+
+def iter_blocks(md_lines):
+    """Walk markdown lines once and yield a stream of typed blocks.
+
+    Tables, ``$$`` equations (optionally preceded by a ``*==label==*`` caption line)
+    and fenced code are grouped into a single block; everything else is one block per line.
+    """
+    source = enumerate(md_lines, 1)
+    pushed = []
+
+    def pull():
+        if pushed:
+            return pushed.pop()
+        return next(source, None)
+
+    while True:
+        item = pull()
+        if item is None:
+            return
+        lineno, line = item
+
+        # 代码块，直到下一个```为止
+        if FENCE_PATTERN.match(line):
+            lines = [line]
+            for _, line in iter(pull, None):
+                lines.append(line)
+                if FENCE_PATTERN.match(line):
+                    break
+            yield Block(block.code, lines, lineno)
             continue
 
-        # 处理代码块
-        if re.match(r'^\s*```', tex_line):
-            # 获取当前代码块的语言
-            if env_stack[-1] != env.raw:
-                lang = re.match(r'^\s*```(\w+)', tex_line).group(1)
-                if args.code_type == 'lstlisting':
-                    tex_content += f'\\begin{{lstlisting}}[language={lang}]\n'
-                else:
-                    tex_content += f'\\begin{{minted}}{{{lang}}}\n'
-                env_stack.append(env.raw)
+        # 标题行之后（可隔若干空行）紧跟表格或公式
+        held = [line]
+        if CAPTION_PATTERN.match(line):
+            item = pull()
+            while item is not None and item[1] == '':
+                held.append(item[1])
+                item = pull()
+            if item is None:
+                yield from (_line_block(lineno + i, l) for i, l in enumerate(held))
+                return
+            line = item[1]
+            if _is_table_line(line) or line.startswith('$$'):
+                held.append(line)
             else:
-                if args.code_type == 'lstlisting':
-                    tex_content += '\\end{lstlisting}\n'
-                else:
-                    tex_content += '\\end{minted}\n'
-                env_stack.pop()
+                pushed.append(item)
+                yield from (_line_block(lineno + i, l) for i, l in enumerate(held))
+                continue
+
+        if _is_table_line(line):
+            first = len(held) - 1
+            item = pull()
+            while item is not None and _is_table_line(item[1]):
+                held.append(item[1])
+                item = pull()
+            if item is not None:
+                pushed.append(item)
+            if len(held) - first >= 2:
+                yield Block(block.table, held, lineno)
+            else:
+                yield from (_line_block(lineno + i, l) for i, l in enumerate(held))
             continue
 
-        # 处理公式块
-        # if re.match(r'^\$\$', tex_line):
-        #     if env_stack[-1] != env.equation:
-        #         env_stack.append(env.equation)
-        #         # if next line is \begin{align}, then use align environment
-        #         if re.match(r'^\s*\\begin{align}', md_content[md_index + 1]):
-        #             align_flag = True
-        #         else:
-        #             tex_content += '\\begin{equation}\n'
-        #     else: 
-        #         env_stack.pop()
-        #         if align_flag:
-        #             align_flag = False
-        #         else:
-        #             tex_content += '\\end{equation}\n'
-        #     continue
-
-        # if re.match(r'^\s*\\begin{table}', tex_line):
-        #     env_stack.append(env.table)
-        # if re.match(r'^\s*\\end{table}', tex_line):
-        #     env_stack.pop()
-
-        # Detect entering / leaving standard math environments produced earlier
-        if re.match(r'^\\begin{(equation|align\*?|gather\*?)}', tex_line):
-            env_stack.append(env.equation)
-        if re.match(r'^\\end{(equation|align\*?|gather\*?)}', tex_line):
-            if env_stack and env_stack[-1] == env.equation:
-                env_stack.pop()
-
-        # 如果当前处于代码块或公式块中（equation env），直接写入
-        if env_stack[-1] in [env.equation, env.raw]:
-            tex_content += tex_line + '\n'
+        # $$可以出现在行中任意位置（包括列表项中缩进的$$），一直取到$$成对为止
+        if '$$' in line:
+            taken = []
+            count = line.count('$$')
+            while count % 2:
+                item = pull()
+                if item is None:
+                    break
+                taken.append(item)
+                count += item[1].count('$$')
+            if count % 2:
+                # 没有闭合的$$，只转换这一行中成对的部分，其余当作普通行处理
+                pushed.extend(reversed(taken))
+                if line.count('$$') >= 2:
+                    yield Block(block.equation, held, lineno)
+                else:
+                    yield from (_line_block(lineno + i, l) for i, l in enumerate(held))
+                continue
+            held.extend(l for _, l in taken)
+            yield Block(block.equation, held, lineno)
             continue
 
-        # --- Inline formatting (protect math & code first) ---
-        masked_line, repls = mask_math_and_code(tex_line)
+        yield _line_block(lineno, line)
+
+TABLE_ALIGN_PATTERN = re.compile(r':?-+:?|:-+|-+:')
+TABLE_LABEL_PATTERN = re.compile(r'\*==(.*?)==\*')
+TABLE_CELL_PATTERN = re.compile(r'[^&]+')
+
+def _table_row(row):
+    """'| a | b |' -> ' a  &  b ': cells separated by ' & ', without the outer separators."""
+    row = row.replace('|', ' & ')
+    stripped = row.lstrip()
+    if stripped.startswith('&'):
+        row = stripped[1:]
+    stripped = row.rstrip()
+    if stripped.endswith('&'):
+        row = stripped[:-1]
+    return row
+
+def _bold_cell(match):
+    return '\\textbf{' + match.group(0).strip() + '}'
+
+def render_table(blk, args):
+    """Render a table block row by row, yielding markdown-level lines.
+
+    The column alignment is computed once from the delimiter row and every body row is
+    rewritten on its own, so the time is linear in the size of the table. Tables with more
+    than args.longtable_rows body rows become a longtable, which can break across pages.
+    """
+    lines = blk.lines
+    indent = ' ' * args.spaces
+    label, caption = None, None
+    if lines[0][0] != '|':
+        # 跳过标题行之后的空行
+        i = 1
+        while i < len(lines) - 1 and lines[i] == '':
+            i += 1
+        label_caption = TABLE_LABEL_PATTERN.findall(lines[0])[0]
+        # 如果有下划线，则分别为label和caption，否则只有caption
+        if '_' in label_caption:
+            label, caption = label_caption.split('_')
+        else:
+            caption = label_caption
+    else:
+        i = 0
+    cols = ''.join('c' if align.startswith(':') and align.endswith(':') else 'r' if align.endswith(':') else 'l'
+                   for align in TABLE_ALIGN_PATTERN.findall(lines[i + 1]))
+    header = TABLE_CELL_PATTERN.sub(_bold_cell, _table_row(lines[i]))
+    body = itertools.islice(lines, i + 2, None)
+    longtable_rows = getattr(args, 'longtable_rows', 0)
 
-        # *==label==* -> \label{label}
-        masked_line = re.sub(r'\*==(.*?)==\*', r'\\label{\1}', masked_line)
+    if longtable_rows and len(lines) - i - 2 > longtable_rows:
+        yield f'\\begin{{longtable}}{{{cols}}}'
+        if caption or label:
+            yield (indent + (f'\\caption{{{caption}}}' if caption else '')
+                   + (f'\\label{{{label}}}' if label else '') + ' \\\\')
+        # 每一页都重复表头
+        for end in ('\\endfirsthead', '\\endhead'):
+            yield f'{indent}\\toprule'
+            yield f'{indent}{header} \\\\'
+            yield f'{indent}\\midrule'
+            yield indent + end
+        yield f'{indent}\\bottomrule'
+        yield f'{indent}\\endlastfoot'
+        for row in body:
+            yield f'{indent}{_table_row(row)} \\\\'
+        yield '\\end{longtable}'
+        return
 
-        # **text** -> \textbf{text}
-        masked_line = re.sub(r'\*\*(.*?)\*\*', r'\\textbf{\1}', masked_line)
+    yield f'\\begin{{table}}[{args.table_pos}]'
+    yield f'{indent}\\centering'
+    if caption:
+        yield f'{indent}\\caption{{{caption}}}'
+    yield f'{indent}\\begin{{tabular}}{{{cols}}}'
+    yield f'{indent}{indent}\\toprule'
+    yield f'        {header} \\\\'
+    yield '        \\midrule'
+    for row in body:
+        yield f'{indent}{indent}{_table_row(row)} \\\\'
+    yield f'{indent}{indent}\\bottomrule'
+    yield f'{indent}\\end{{tabular}}'
+    if label:
+        yield f'{indent}\\label{{{label}}}'
+    yield '\\end{table}'
 
-        # *text* -> \textit{text} (avoid conflicts with already converted **)
-        masked_line = re.sub(r'(?<!\\)\*(?!\*)([^*]+?)\*(?!\*)', r'\\textit{\1}', masked_line)
+EQUATION_SPAN_PATTERN = re.compile(r'\$\$(.+?)\$\$', re.DOTALL)
+def render_equation(blk, args):
+    """Render every ``$$`` span of a block through equations_convert, keeping the text around them."""
+    lines = blk.lines
+    m = CAPTION_PATTERN.match(lines[0])
+    if m:
+        # 带标签的公式只能是紧跟在标签行后面、以$$开头的那一个
+        start = 1
+        while lines[start] == '':
+            start += 1
+        text = '\n'.join(lines[start:])[2:]
+        end = text.index('$$')
+        tex = equations_convert([(None, m.group(1), text[:end])], True, args)[0]
+        text = tex + text[end + 2:]
+    else:
+        text = '\n'.join(lines)
+    text = EQUATION_SPAN_PATTERN.sub(lambda m: equations_convert([(None, m.group(1))], False, args)[0], text)
+    return text.split('\n')
+
+LEVEL1_PATTERN = re.compile(r'#\s')
+MATH_BEGIN_PATTERN = re.compile(r'^\\begin{(equation|align\*?|gather\*?)}')
+MATH_END_PATTERN = re.compile(r'^\\end{(equation|align\*?|gather\*?)}')
+FENCE_LANG_PATTERN = re.compile(r'^\s*```(\w+)')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+ZOOM_PATTERN = re.compile(r'zoom:\s*(\d+)%')
 
-        # inline code placeholders are restored later; convert actual inline code to minted/verb
-        # (Already masked, so we transform after unmask)
+def _underline_repl(m):
+    inner = m.group(1).strip()
+    return f'\\underline{{{inner}}}'
 
-        tex_line = _unmask(masked_line, repls)
+def _font_repl(m):
+    color = m.group(1)
+    inner = m.group(2).strip()
+    return f'\\textcolor{{{color}}}{{{inner}}}'
 
-        # Support underline <u>...</u>
-        def _u_repl(m):
-            inner = m.group(1).strip()
-            return f'\\underline{{{inner}}}'
-        tex_line = re.sub(r'<u[^>]*>(.+?)</u>', _u_repl, tex_line, flags=re.IGNORECASE)
+def _apply_rules(rule_table, line):
+    """Run (guard, pattern, replacement) rules in order, skipping those whose guard substring is absent."""
+    for guard, pattern, repl in rule_table:
+        if guard in line:
+            line = pattern.sub(repl, line)
+    return line
 
-        # Support <font color=...>...</font> (simplified); require \usepackage{xcolor} in template
-        def _font_repl(m):
-            color = m.group(1)
-            inner = m.group(2).strip()
-            return f'\\textcolor{{{color}}}{{{inner}}}'
-        tex_line = re.sub(r'<font[^>]*?color\s*=\s*["\']?([A-Za-z]+)["\']?[^>]*>(.+?)</font>', _font_repl, tex_line, flags=re.IGNORECASE)
+class InlineRules:
+    """Precompiled per-line rewrite rules for one set of options.
 
+    Patterns are compiled and replacement templates (figure position, indentation,
+    code environment) are built once here instead of for every line.
+    """
+    def __init__(self, figure_pos, spaces, code_type):
+        indent = ' ' * spaces  # 获取动态缩进
+        self.indent = indent
+        figure_begin = r'\\begin{figure}[' + figure_pos + r']\n' + indent + r'\\centering\n' + indent
+
+        # 需要先屏蔽行内公式和代码的规则
+        self.emphasis = [
+            # *==label==* -> \label{label}
+            ('*==', re.compile(r'\*==(.*?)==\*'), r'\\label{\1}'),
+            # **text** -> \textbf{text}
+            ('**', re.compile(r'\*\*(.*?)\*\*'), r'\\textbf{\1}'),
+            # *text* -> \textit{text} (avoid conflicts with already converted **)
+            ('*', re.compile(r'(?<!\\)\*(?!\*)([^*]+?)\*(?!\*)'), r'\\textit{\1}'),
+        ]
+        self.html_inline = [
+            # Support underline <u>...</u>
+            ('<', re.compile(r'<u[^>]*>(.+?)</u>', re.IGNORECASE), _underline_repl),
+            # Support <font color=...>...</font> (simplified); require \usepackage{xcolor} in template
+            ('<', re.compile(r'<font[^>]*?color\s*=\s*["\']?([A-Za-z]+)["\']?[^>]*>(.+?)</font>', re.IGNORECASE), _font_repl),
+        ]
         # `code` -> inline code formatting (now safe because math restored)
-        if args.code_type == 'lstlisting':
-            tex_line = re.sub(r'`([^`]+?)`', r'\\verb|\1|', tex_line)
+        if code_type == 'lstlisting':
+            self.inline_code = [('`', re.compile(r'`([^`]+?)`'), r'\\verb|\1|')]
+            self.code_begin = '\\begin{{lstlisting}}[language={}]'
+            self.code_end = '\\end{lstlisting}'
         else:
-            tex_line = re.sub(r'`([^`]+?)`', r'\\mintinline{text}|\1|', tex_line)
-
+            self.inline_code = [('`', re.compile(r'`([^`]+?)`'), r'\\mintinline{text}|\1|')]
+            self.code_begin = '\\begin{{minted}}{{{}}}'
+            self.code_end = '\\end{minted}'
         # 根据是否有一级标题进行处理
-        if level1:
-            # # section -> \section{section}
-            tex_line = re.sub(r'^#\s+(.*)', r'\\section{\1}', tex_line)
-            
-            # ## subsection -> \subsection{subsection}
-            tex_line = re.sub(r'^##\s+(.*)', r'\\subsection{\1}', tex_line)
-            
-            # ### subsubsection -> \subsubsection{subsubsection}
-            tex_line = re.sub(r'^###\s+(.*)', r'\\subsubsection{\1}', tex_line)
+        self.headings = {
+            True: [
+                ('#', re.compile(r'^#\s+(.*)'), r'\\section{\1}'),
+                ('#', re.compile(r'^##\s+(.*)'), r'\\subsection{\1}'),
+                ('#', re.compile(r'^###\s+(.*)'), r'\\subsubsection{\1}'),
+                ('#', re.compile(r'^######\s+(.*)'), r'\\paragraph{\1}'),
+            ],
+            False: [
+                ('#', re.compile(r'^##\s+(.*)'), r'\\section{\1}'),
+                ('#', re.compile(r'^###\s+(.*)'), r'\\subsection{\1}'),
+                ('#', re.compile(r'^####\s+(.*)'), r'\\subsubsection{\1}'),
+                ('#', re.compile(r'^######\s+(.*)'), r'\\paragraph{\1}'),
+            ],
+        }
+        self.percent = re.compile(r'([^\\])%')
+        self.links = [
+            # [@reference] -> \cite{reference}
+            ('[@', re.compile(r'\[@(.*?)\]'), r'\\cite{\1}'),
+            # [#label] -> \ref{label}
+            ('[#', re.compile(r'\[#(.*?)\]'), r'\\ref{\1}'),
+            # 处理图片，顺序不要颠倒
+            # ![](img_path "caption")
+            ('![', re.compile(r'!\[\]\((.*?)\s*"(.*?)"\)'),
+             figure_begin + r'\\includegraphics[width=\\textwidth]{\1}\n' + indent + r'\\caption{\2}\n' + r'\\end{figure}'),
+            # ![](img_path)
+            ('![', re.compile(r'!\[\]\((.*?)\)'),
+             figure_begin + r'\\includegraphics[width=\\textwidth]{\1}\n' + r'\\end{figure}'),
+            # ![label](img_path "caption")
+            ('![', re.compile(r'!\[(.*?)\]\((.*?)\s*"(.*?)"\)'),
+             figure_begin + r'\\includegraphics[width=\\textwidth]{\2}\n' + indent + r'\\caption{\3}\n' + indent + r'\\label{\1}\n' + r'\\end{figure}'),
+            # ![label](img_path)
+            ('![', re.compile(r'!\[(.*?)\]\((.*?)\)'),
+             figure_begin + r'\\includegraphics[width=\\textwidth]{\2}\n' + indent + r'\\label{\1}\n' + r'\\end{figure}'),
+            # [label](url) -> \href{url}{label}
+            ('](', re.compile(r'\[(.*?)\]\((.*?)\)'), r'\\href{\2}{\1}'),
+        ]
+        # <img>转换得到的figure环境
+        self.html_figure_begin = ('\\begin{figure}[' + figure_pos + ']\n'
+                                  f'{indent}\\centering\n'
+                                  f'{indent}\\includegraphics[width=')
+        # 列表项
+        self.itemize_pattern = re.compile(r'^\s*-\s+(.*)')
+        self.enumerate_pattern = re.compile(r'^\s*\d+\.\s+(.*)')
+        self.item_repl = indent + r'\\item \1'
+        # 屏蔽与HTML解析，ProfiledConverter会替换为带计时的版本
+        self.mask = mask_math_and_code
+        self.unmask = _unmask
+        self.has_html = has_html
+        self.parse_html = parse_html_tags
+        # 相同的<img>标签只生成一次figure环境
+        self.figures = {}
 
-        else:
-            # ## section -> \section{section}
-            tex_line = re.sub(r'^##\s+(.*)', r'\\section{\1}', tex_line)
-            
-            # ### subsection -> \subsection{subsection}
-            tex_line = re.sub(r'^###\s+(.*)', r'\\subsection{\1}', tex_line)
-            
-            # #### subsubsection -> \subsubsection{subsubsection}
-            tex_line = re.sub(r'^####\s+(.*)', r'\\subsubsection{\1}', tex_line)
-        
-        # ###### paragraph -> \paragraph{paragraph}
-        tex_line = re.sub(r'^######\s+(.*)', r'\\paragraph{\1}', tex_line)
+    def convert(self, tex_line, level1):
+        """Apply the inline rewrites to one line outside code and equation environments."""
+        # --- Inline formatting (protect math & code first) ---
+        if '*' in tex_line:
+            masked_line, repls = self.mask(tex_line)
+            masked_line = _apply_rules(self.emphasis, masked_line)
+            tex_line = self.unmask(masked_line, repls)
+
+        if '<' in tex_line:
+            tex_line = _apply_rules(self.html_inline, tex_line)
+
+        tex_line = _apply_rules(self.inline_code, tex_line)
 
+        if tex_line.startswith('#'):
+            tex_line = _apply_rules(self.headings[level1], tex_line)
 
         # # _ -> \_ if _ is not preceded by \ and not in inline math mode
         # tex_line = re.sub(r'(?<!\\)(?<!\\$)_', r'\\_', tex_line)
 
-        # # % -> \%
-        if not has_html(tex_line):
-            tex_line = re.sub(r'([^\\])%', r'\1\\%', tex_line)
+        # 每行只检测一次HTML，之后只有链接规则修改了该行时才需要重新检测
+        html = self.has_html(tex_line)
 
-        # [@reference] -> \cite{reference}
-        tex_line = re.sub(r'\[@(.*?)\]', r'\\cite{\1}', tex_line)
+        # # % -> \%
+        if '%' in tex_line and not html:
+            tex_line = self.percent.sub(r'\1\\%', tex_line)
 
-        # [#label] -> \ref{label}
-        tex_line = re.sub(r'\[#(.*?)\]', r'\\ref{\1}', tex_line)
-        
-        # 处理图片，顺序不要颠倒
-        # ![](img_path "caption") -> \begin{figure}[args.figure_pos]\n    \centering\n    \includegraphics[width=\textwidth]{img_path}\n    \caption{caption}\\n\end{figure}
-        tex_line = re.sub(
-            r'!\[\]\((.*?)\s*"(.*?)"\)',
-            r'\\begin{figure}[' + args.figure_pos + r']\n' + indent + r'\\centering\n' + indent + r'\\includegraphics[width=\\textwidth]{\1}\n' + indent + r'\\caption{\2}\n' + r'\\end{figure}',
-            tex_line
-        )
-        # ![](img_path) -> \begin{figure}[args.figure_pos]\n    \centering\n    \includegraphics[width=\textwidth]{img_path}\n\end{figure}
-        tex_line = re.sub(
-            r'!\[\]\((.*?)\)',
-            r'\\begin{figure}[' + args.figure_pos + r']\n' + indent + r'\\centering\n' + indent + r'\\includegraphics[width=\\textwidth]{\1}\n' + r'\\end{figure}',
-            tex_line
-        )
-        # ![label](img_path "caption") -> \begin{figure}[args.figure_pos]\n    \centering\n    \includegraphics[width=\textwidth]{img_path}\n    \caption{caption}\n    \label{label}\n\end{figure}
-        tex_line = re.sub(
-            r'!\[(.*?)\]\((.*?)\s*"(.*?)"\)',
-            r'\\begin{figure}[' + args.figure_pos + r']\n' + indent + r'\\centering\n' + indent + r'\\includegraphics[width=\\textwidth]{\2}\n' + indent + r'\\caption{\3}\n' + indent + r'\\label{\1}\n' + r'\\end{figure}',
-            tex_line
-        )
-        # ![label](img_path) -> \begin{figure}[args.figure_pos]\n    \centering\n    \includegraphics[width=\textwidth]{img_path}\n    \label{label}\n\end{figure}
-        tex_line = re.sub(
-            r'!\[(.*?)\]\((.*?)\)',
-            r'\\begin{figure}[' + args.figure_pos + r']\n' + indent + r'\\centering\n' + indent + r'\\includegraphics[width=\\textwidth]{\2}\n' + indent + r'\\label{\1}\n' + r'\\end{figure}',
-            tex_line
-        )
-
-        # [label](url) -> \href{url}{label}
-        tex_line = re.sub(r'\[(.*?)\]\((.*?)\)', r'\\href{\2}{\1}', tex_line)
+        if '[' in tex_line:
+            linked = _apply_rules(self.links, tex_line)
+            if linked != tex_line:
+                tex_line = linked
+                html = self.has_html(tex_line)
 
         # HTML标签处理 (after other inline conversions to avoid impacting replacements)
-        if has_html(tex_line):
-            html_parser = MdHtmlParser()
-            html_parser.feed(tex_line)
-            tag = html_parser.tag
-            attrs = html_parser.attrs or {}
-            if tag == 'img':
+        if html:
+            tex_line = self.convert_html(tex_line)
+        return tex_line
+
+    def img_figure(self, attrs):
+        """The figure environment for the attributes of one <img> tag."""
+        indent = self.indent
+        html_line = self.html_figure_begin
+        if 'style' in attrs:
+            zoom = ZOOM_PATTERN.search(attrs['style'])
+            if zoom:
+                html_line += f'{int(zoom.group(1)) / 100:.2f}\\textwidth'
+            else:
+                html_line += r'\textwidth'
+        else:
+            html_line += r'\textwidth'
+        html_line += f']{{{attrs["src"]}}}\n'
+        if 'title' in attrs:
+            html_line += f'{indent}\\caption{{{attrs["title"]}}}\n'
+        if 'alt' in attrs:
+            html_line += f'{indent}\\label{{{attrs["alt"]}}}\n'
+        return html_line + '\\end{figure}'
+
+    def convert_html(self, tex_line):
+        """Replace a line with <img> tags by their figures; other tags are stripped."""
+        figures = []
+        unsupported = []
+        for text, tag, attrs in self.parse_html(tex_line):
+            if tag != 'img':
+                unsupported.append(tag)
+                continue
+            figure = self.figures.get(text)
+            if figure is None:
                 if 'src' not in attrs:
                     print(WARN + 'The img tag must have a src attribute, replaced with blank content')
-                    tex_line = re.sub(r'<[^>]+>', '', tex_line)
-                else:
-                    # Build figure environment string (avoid raw string escape warnings)
-                    html_line = ('\\begin{figure}[' + args.figure_pos + f']\n'
-                                  f'{indent}\\centering\n'
-                                  f'{indent}\\includegraphics[width=')
-                    if 'style' in attrs:
-                        zoom = re.search(r'zoom:\s*(\d+)%', attrs['style'])
-                        if zoom:
-                            html_line += f'{int(zoom.group(1)) / 100:.2f}\\textwidth'
-                        else:
-                            html_line += r'\textwidth'
+                    continue
+                if len(self.figures) >= 4096:
+                    self.figures.clear()
+                figure = self.figures[text] = self.img_figure(attrs)
+            figures.append(figure)
+        # 有图片的行中其他标签同样被丢弃，也要提示
+        for tag in unsupported:
+            print(WARN + f'Unsupported HTML tag: {tag}, stripped.')
+        if figures:
+            return '\n'.join(figures)
+        return TAG_PATTERN.sub('', tex_line)
+
+def iter_lines(text):
+    """Yield the lines of a string lazily, the same way text.split('\\n') would, without building the list."""
+    find = text.find
+    start = 0
+    end = find('\n')
+    while end >= 0:
+        yield text[start:end]
+        start = end + 1
+        end = find('\n', start)
+    yield text[start:]
+
+def read_lines(f):
+    """Yield the lines of a text file without their newline, the same way str.split('\\n') would."""
+    line = ''
+    for line in f:
+        yield line[:-1] if line.endswith('\n') else line
+    if line == '' or line.endswith('\n'):
+        yield ''
+
+@dataclass(frozen=True)
+class Config:
+    """Options that affect the generated latex; hashable so converters can be cached per config."""
+    figure_pos: str = 'ht'
+    table_pos: str = 'ht'
+    spaces: int = 4
+    code_type: str = 'minted'
+    have_title: bool = False
+    longtable_rows: int = 500
+
+    @classmethod
+    def from_args(cls, args):
+        """Build a Config from any object with the same attribute names (e.g. argparse results)."""
+        return cls(**{f.name: getattr(args, f.name, f.default) for f in fields(cls)})
+
+class Converter:
+    """Markdown to latex converter for one Config, with all derived state prepared up front."""
+    # 各阶段的实现，ProfiledConverter会替换为带计时的版本
+    iter_blocks = staticmethod(iter_blocks)
+    render_table = staticmethod(render_table)
+    render_equation = staticmethod(render_equation)
+
+    def __init__(self, config=Config()):
+        self.config = config
+        self.rules = InlineRules(config.figure_pos, config.spaces, config.code_type)
+
+    def convert(self, md_content):
+        """Convert a markdown string."""
+        return ''.join(self._iter_convert(iter_lines(md_content)))
+
+    def convert_file(self, path):
+        """Convert a markdown file."""
+        with open(path, 'r', encoding='utf-8') as f:
+            return ''.join(self._iter_convert(read_lines(f)))
+
+    def convert_many(self, md_contents):
+        """Convert each markdown string of an iterable, yielding the results in order."""
+        for md_content in md_contents:
+            yield self.convert(md_content)
+
+    def iter_convert(self, md_lines):
+        """Convert an iterable of markdown lines to latex, yielding chunks as they are produced.
+
+        md_lines are lines with their newlines, as iterating a file or str.splitlines(True)
+        gives them; joining the chunks equals convert() of the joined lines.
+        """
+        return self._iter_convert(read_lines(md_lines))
+
+    def _iter_convert(self, md_lines):
+        # md_lines中的行已经不带换行符
+        level1, md_lines = self.start(md_lines)
+        env_stack = [env.document]
+        sep = yield from self.convert_blocks(self.iter_blocks(md_lines), level1, env_stack, '')
+        yield from self.close_envs(env_stack, sep)
+
+    def start(self, md_lines):
+        """Decide the heading levels from the first line; returns (level1, remaining lines)."""
+        md_lines = iter(md_lines)
+        first = next(md_lines, None)
+        if first is None:
+            return False, []
+        second = next(md_lines, None)
+
+        # 检测是否有一级标题存在
+        if LEVEL1_PATTERN.match(first if second is None else first + '\n'):
+            level1 = True
+        else:
+            level1 = False
+    
+        if self.config.have_title and level1:
+            level1 = False
+            # 删除开头的一级标题以及其后的空行
+            md_lines = itertools.dropwhile(lambda line: line == '', itertools.chain([second or ''], md_lines))
+            # 全部删除时仍保留一个空行
+            md_lines = itertools.chain([next(md_lines, '')], md_lines)
+        elif second is None:
+            md_lines = [first]
+        else:
+            md_lines = itertools.chain([first, second], md_lines)
+        return level1, md_lines
+
+    def convert_blocks(self, blocks, level1, env_stack, sep):
+        """Convert a stream of blocks, yielding chunks; returns the separator owed to the next chunk.
+
+        Every chunk is yielded without its trailing newline, which is passed on as sep and
+        prepended to the next chunk. Closing a list drops the owed newline instead of
+        rewriting output that was already yielded. env_stack is updated in place.
+        """
+        for blk in blocks:
+            out = []
+            sep = self.emit_blocks((blk,), level1, env_stack, sep, out)
+            yield from out
+        return sep
+
+    def emit_blocks(self, blocks, level1, env_stack, sep, out):
+        """convert_blocks without the generator: appends the chunks to out and returns the owed separator."""
+        append = out.append
+        config = self.config
+        rules = self.rules
+
+        for blk in blocks:
+            # 处理代码块
+            if blk.kind == block.code:
+                # 获取当前代码块的语言
+                lang = FENCE_LANG_PATTERN.match(blk.lines[0]).group(1)
+                append(sep + rules.code_begin.format(lang))
+                env_stack.append(env.raw)
+                for line in blk.lines[1:]:
+                    if FENCE_PATTERN.match(line):
+                        append('\n' + rules.code_end)
+                        env_stack.pop()
                     else:
-                        html_line += r'\textwidth'
-                    html_line += f']{{{attrs["src"]}}}\n'
-                    if 'title' in attrs:
-                        html_line += f'{indent}\\caption{{{attrs["title"]}}}\n'
-                    if 'alt' in attrs:
-                        html_line += f'{indent}\\label{{{attrs["alt"]}}}\n'
-                    html_line += '\\end{figure}'
-                    tex_line = html_line
+                        append('\n' + line)
+                sep = '\n'
+                continue
+
+            if blk.kind == block.table:
+                lines = self.render_table(blk, config)
+            elif blk.kind == block.equation:
+                lines = self.render_equation(blk, config)
             else:
-                print(WARN + f'Unsupported HTML tag: {tag}, stripped.')
-                tex_line = re.sub(r'<[^>]+>', '', tex_line)
+                lines = blk.lines
 
+            for md_line in lines:
+                tex_line = md_line
 
-        # 处理无序列表
-        if md_line.startswith('- '):
-            if env_stack[-1] != env.itemize:
-                tex_content += '\\begin{itemize}\n'
-                env_stack.append(env.itemize)
-            tex_line = re.sub(r'^\s*-\s+(.*)', indent + r'\\item \1', tex_line)
-        else:
+                # 处理空行
+                if md_line == '': 
+                    if sep:
+                        append(sep)
+                    sep = '\n'
+                    continue
+
+                # Detect entering / leaving standard math environments produced earlier
+                if tex_line[0] == '\\':
+                    if MATH_BEGIN_PATTERN.match(tex_line):
+                        env_stack.append(env.equation)
+                    if MATH_END_PATTERN.match(tex_line):
+                        if env_stack and env_stack[-1] == env.equation:
+                            env_stack.pop()
+
+                # 如果当前处于代码块或公式块中（equation env），直接写入
+                if env_stack[-1] in [env.equation, env.raw]:
+                    append(sep + tex_line)
+                    sep = '\n'
+                    continue
+
+                tex_line = rules.convert(tex_line, level1)
+
+                # 处理无序列表
+                if md_line.startswith('- '):
+                    if env_stack[-1] != env.itemize:
+                        append(sep + '\\begin{itemize}')
+                        sep = '\n'
+                        env_stack.append(env.itemize)
+                    tex_line = rules.itemize_pattern.sub(rules.item_repl, tex_line)
+                else:
+                    if env_stack[-1] == env.itemize:
+                        # 去掉上一行的换行符
+                        append('\\end{itemize}\n')
+                        sep = '\n'
+                        env_stack.pop()
+
+                # 处理有序列表
+                if LIST_NUM_PATTERN.match(md_line):
+                    if env_stack[-1] != env.enumerate:
+                        append(sep + '\\begin{enumerate}')
+                        sep = '\n'
+                        env_stack.append(env.enumerate)
+                    tex_line = rules.enumerate_pattern.sub(rules.item_repl, tex_line)
+                else:
+                    if env_stack[-1] == env.enumerate:
+                        # 去掉上一行的换行符
+                        append('\\end{enumerate}\n')
+                        sep = '\n'
+                        env_stack.pop()
+        
+                # 为每一段添加\par
+                # if not tex_line.startswith('\\') and env_stack[-1] not in [env.itemize, env.enumerate, env.table]:
+                #     tex_line = '\\par ' + tex_line
+
+                append(sep + tex_line)
+                sep = '\n'
+        return sep
+
+    def close_envs(self, env_stack, sep):
+        """Close every environment still open at the end of the document."""
+        # 关闭所有未关闭的环境
+        while len(env_stack) > 1:
             if env_stack[-1] == env.itemize:
-                # 删除tex_content最后一个换行符
-                tex_content = tex_content[:-1]
-                tex_content += '\\end{itemize}\n\n'
-                env_stack.pop()
-
-        # 处理有序列表
-        if re.match(r'^\s*\d+\.\s+', md_line):
-            if env_stack[-1] != env.enumerate:
-                tex_content += '\\begin{enumerate}\n'
-                env_stack.append(env.enumerate)
-            tex_line = re.sub(r'^\s*\d+\.\s+(.*)', indent + r'\\item \1', tex_line)
+                yield sep + '\\end{itemize}'
+                sep = '\n'
+            elif env_stack[-1] == env.enumerate:
+                yield sep + '\\end{enumerate}'
+                sep = '\n'
+            env_stack.pop()
+        if sep:
+            yield sep
+
+@functools.lru_cache(maxsize=32)
+def get_converter(config):
+    """Return a cached Converter for the config, so repeated calls with the same options skip the setup."""
+    return Converter(config)
+
+class Profiler:
+    """Calls, matches and cumulative time of each conversion stage and inline rule."""
+    def __init__(self):
+        self.counters = {}  # 名称 -> [调用次数, 匹配次数, 累计时间]
+
+    def add(self, name, seconds, matches=0):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = [0, 0, 0.0]
+        counter[0] += 1
+        counter[1] += matches
+        counter[2] += seconds
+
+    def wrap(self, name, func, matches=None):
+        """Return func recording every call under name; matches(result) gives the match count."""
+        def wrapper(*args):
+            start = time.perf_counter()
+            result = func(*args)
+            self.add(name, time.perf_counter() - start, matches(result) if matches else 0)
+            return result
+        return wrapper
+
+    def wrap_iter(self, name, func):
+        """Like wrap for a generator function; every produced item counts as one call."""
+        def wrapper(*args):
+            items = func(*args)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                self.add(name, time.perf_counter() - start, 1)
+                yield item
+        return wrapper
+
+    def to_json(self):
+        return {name: {'calls': calls, 'matches': matches, 'seconds': seconds}
+                for name, (calls, matches, seconds) in self.counters.items()}
+
+    def report(self):
+        """Print the counters ranked by cumulative time."""
+        print(f'{"seconds":>9} {"calls":>9} {"matches":>9}  stage')
+        for name, (calls, matches, seconds) in sorted(self.counters.items(), key=lambda item: -item[1][2]):
+            print(f'{seconds:>9.4f} {calls:>9} {matches:>9}  {name}')
+
+class _ProfiledPattern:
+    """Compiled pattern whose sub() is recorded in a Profiler, counting substitutions as matches."""
+    def __init__(self, name, pattern, profiler):
+        self.name = name
+        self.pattern = pattern
+        self.profiler = profiler
+
+    def sub(self, repl, string):
+        start = time.perf_counter()
+        result, n = self.pattern.subn(repl, string)
+        self.profiler.add(self.name, time.perf_counter() - start, n)
+        return result
+
+class ProfiledConverter(Converter):
+    """Converter recording every stage and inline rule in a Profiler.
+
+    The instrumented stages and rule tables are swapped in on this instance only, so the
+    plain Converter pays nothing for profiling.
+    """
+    def __init__(self, config=Config(), profiler=None):
+        super().__init__(config)
+        self.profiler = p = profiler or Profiler()
+        self.iter_blocks = p.wrap_iter('blocks: split', iter_blocks)
+        # 每个表格记一次调用，matches为输出的行数
+        self.render_table = p.wrap('blocks: tables', lambda blk, args: list(render_table(blk, args)), len)
+        self.render_equation = p.wrap('blocks: equations', render_equation, len)
+
+        def profiled(group, rule_table):
+            return [(guard, _ProfiledPattern(f'{group}: {pattern.pattern}', pattern, p), repl)
+                    for guard, pattern, repl in rule_table]
+
+        rules = self.rules = copy.copy(self.rules)
+        rules.emphasis = profiled('emphasis', rules.emphasis)
+        rules.html_inline = profiled('html inline', rules.html_inline)
+        rules.inline_code = profiled('inline code', rules.inline_code)
+        rules.headings = {level1: profiled('heading', table) for level1, table in rules.headings.items()}
+        rules.links = profiled('link', rules.links)
+        rules.percent = _ProfiledPattern('percent: ' + rules.percent.pattern, rules.percent, p)
+        rules.itemize_pattern = _ProfiledPattern('list: itemize', rules.itemize_pattern, p)
+        rules.enumerate_pattern = _ProfiledPattern('list: enumerate', rules.enumerate_pattern, p)
+        rules.mask = p.wrap('inline: mask math/code', rules.mask, lambda masked: len(masked[1][1]))
+        rules.unmask = p.wrap('inline: unmask', rules.unmask)
+        rules.has_html = p.wrap('html: detect', rules.has_html, int)
+        rules.parse_html = p.wrap('html: parse tags', rules.parse_html, len)
+        rules.img_figure = p.wrap('html: img figure', rules.img_figure)
+        rules.convert = p.wrap('inline: all rules', rules.convert)
+
+XREF_PATTERN = re.compile(r'\\(label|ref|eqref|autoref|pageref|cite|citep|citet)\{([^{}]*)\}')
+BIB_ENTRY_PATTERN = re.compile(r'@(\w+)\s*[{(]\s*([^\s,{}()]+)\s*,')
+
+def read_bib_keys(paths):
+    """The set of entry keys in the given .bib files (@string, @preamble and @comment are skipped)."""
+    keys = set()
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for kind, key in BIB_ENTRY_PATTERN.findall(f.read()):
+                if kind.lower() not in ('string', 'preamble', 'comment'):
+                    keys.add(key)
+    return keys
+
+class XrefIndex:
+    """Labels, references and citations of one document with their markdown line numbers."""
+    def __init__(self):
+        self.labels = {}      # 标签 -> (类型, 行号)
+        self.duplicates = {}  # 重复定义的标签 -> [行号]
+        self.refs = {}        # 标签 -> [行号]
+        self.cites = {}       # 文献 -> [行号]
+
+    def add(self, tex, lineno, kind):
+        """Record every \\label, \\ref and \\cite in the latex converted from one block."""
+        for command, name in XREF_PATTERN.findall(tex):
+            if command == 'label':
+                if name in self.labels:
+                    self.duplicates.setdefault(name, [self.labels[name][1]]).append(lineno)
+                else:
+                    self.labels[name] = (kind, lineno)
+            elif command.startswith('cite'):
+                for key in name.split(','):
+                    self.cites.setdefault(key.strip(), []).append(lineno)
+            else:
+                self.refs.setdefault(name, []).append(lineno)
+
+    def check(self, bib_keys=None):
+        """Dangling refs, unused labels, duplicate labels and (given bib_keys) missing citations."""
+        labels = self.labels
+        problems = {
+            'dangling_refs': {name: lines for name, lines in self.refs.items() if name not in labels},
+            'unused_labels': {name: line for name, (_, line) in labels.items() if name not in self.refs},
+            'duplicate_labels': self.duplicates,
+        }
+        if bib_keys is not None:
+            problems['missing_cites'] = {key: lines for key, lines in self.cites.items() if key not in bib_keys}
+        return problems
+
+    def to_json(self, bib_keys=None):
+        return {'labels': {name: list(value) for name, value in self.labels.items()},
+                'refs': self.refs, 'cites': self.cites, **self.check(bib_keys)}
+
+    def report(self, bib_keys=None):
+        """Print the problems found; returns their number (unused labels are not counted)."""
+        problems = self.check(bib_keys)
+        count = 0
+        for name, lines in problems['dangling_refs'].items():
+            count += 1
+            print(WARN + f'Undefined label \"{name}\" referenced on line {", ".join(map(str, lines))}')
+        for name, lines in problems['duplicate_labels'].items():
+            count += 1
+            print(WARN + f'Label \"{name}\" defined more than once, on line {", ".join(map(str, lines))}')
+        for key, lines in problems.get('missing_cites', {}).items():
+            count += 1
+            print(WARN + f'Citation \"{key}\" on line {", ".join(map(str, lines))} is not in the bib file')
+        for name, line in problems['unused_labels'].items():
+            print(INFO + f'Label \"{name}\" (line {line}) is never referenced')
+        print(INFO + f'{len(self.labels)} labels, {sum(map(len, self.refs.values()))} references, '
+              f'{sum(map(len, self.cites.values()))} citations, {count} problem(s)')
+        return count
+
+INCLUDEGRAPHICS_PATTERN = re.compile(r'(\\includegraphics(?:\[[^\]]*\])?\{)([^{}]*)(\})')
+# latex按顺序尝试的扩展名，以及pdflatex能直接插入的图片格式
+GRAPHICS_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.eps')
+LATEX_IMAGE_FORMATS = ('pdf', 'png', 'jpeg', 'eps')
+IMAGE_MAX_BYTES = 10 << 20
+IMAGE_MAX_PIXELS = 40_000_000
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def _image_header(f, ext):
+    """(format, width, height) from the first bytes of an image file, without decoding it."""
+    head = f.read(32)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return ('png',) + struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return ('gif',) + struct.unpack('<HH', head[6:10])
+    if head.startswith(b'%PDF'):
+        return 'pdf', None, None
+    if head.startswith(b'\xff\xd8'):
+        # 依次跳过各个段，直到帧头（SOF）中的尺寸
+        f.seek(2)
+        while f.read(1) == b'\xff':
+            code = f.read(1)
+            while code == b'\xff':
+                code = f.read(1)
+            if not code or code[0] in (0xD9, 0xDA):
+                break
+            if code[0] == 0x01 or 0xD0 <= code[0] <= 0xD7:
+                continue
+            length = f.read(2)
+            if len(length) < 2:
+                break
+            if code[0] in JPEG_SOF_MARKERS:
+                height, width = struct.unpack('>HH', f.read(5)[1:])
+                return 'jpeg', width, height
+            f.seek(struct.unpack('>H', length)[0] - 2, 1)
+        return 'jpeg', None, None
+    return ext.lstrip('.').lower() or None, None, None
+
+_images = {}
+
+def image_info(path):
+    """(format, width, height, bytes) of an image file, or None if it does not exist.
+
+    Only the header is read; the result is cached by path and mtime.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _images.get(path)
+    if cached is None or cached[0] != st.st_mtime_ns:
+        try:
+            with open(path, 'rb') as f:
+                fmt, width, height = _image_header(f, os.path.splitext(path)[1])
+        except (OSError, struct.error):
+            fmt, width, height = None, None, None
+        cached = _images[path] = (st.st_mtime_ns, (fmt, width, height, st.st_size))
+    return cached[1]
+
+def _resolve_image(path):
+    """The image file latex will use for path (trying GRAPHICS_EXTENSIONS if it has none) and its info."""
+    info = image_info(path)
+    if info is None and not os.path.splitext(path)[1]:
+        for ext in GRAPHICS_EXTENSIONS:
+            info = image_info(path + ext)
+            if info is not None:
+                return path + ext, info
+    return path, info
+
+class AssetStage:
+    """Images of one document: resolved and read on a thread pool while the conversion goes on.
+
+    Paths in the markdown are relative to base_dir (the directory of the markdown file).
+    With tex_dir, every \\includegraphics path is rewritten relative to that directory.
+    """
+    def __init__(self, base_dir='.', tex_dir=None, workers=None):
+        self.base_dir = base_dir
+        self.tex_dir = tex_dir
+        self.executor = ThreadPoolExecutor(workers)
+        self.images = {}  # markdown中的路径 -> [行号]
+        self.futures = {}
+
+    def _include(self, match, lineno):
+        path = match.group(2)
+        lines = self.images.get(path)
+        if lines is None:
+            lines = self.images[path] = []
+            if '://' not in path:
+                full = os.path.normpath(os.path.join(self.base_dir, path))
+                self.futures[path] = (full, self.executor.submit(_resolve_image, full))
+        lines.append(lineno)
+        if self.tex_dir is None or path not in self.futures or os.path.isabs(path):
+            return match.group(0)
+        new_path = os.path.relpath(self.futures[path][0], self.tex_dir).replace(os.sep, '/')
+        return match.group(1) + new_path + match.group(3)
+
+    def rewrite(self, tex, lineno):
+        """Record the images in tex, returning it with the paths rewritten if tex_dir is set."""
+        return INCLUDEGRAPHICS_PATTERN.sub(lambda match: self._include(match, lineno), tex)
+
+    def manifest(self):
+        """Wait for every image; returns one entry per image path in the order of first use."""
+        entries = []
+        for path, lines in self.images.items():
+            entry = {'path': path, 'lines': lines}
+            if path in self.futures:
+                full, future = self.futures[path]
+                file, info = future.result()
+                if self.tex_dir is not None and not os.path.isabs(path):
+                    entry['tex_path'] = os.path.relpath(full, self.tex_dir).replace(os.sep, '/')
+                entry['file'] = file
+                entry['exists'] = info is not None
+                if info is not None:
+                    entry['format'], entry['width'], entry['height'], entry['bytes'] = info
+            else:
+                entry['exists'] = None
+            entries.append(entry)
+        self.executor.shutdown()
+        return entries
+
+    def report(self, entries):
+        """Print a warning for every missing, unsupported or oversized image; returns their number."""
+        count = 0
+        for entry in entries:
+            where = f'Image \"{entry["path"]}\" (line {", ".join(map(str, entry["lines"]))})'
+            if entry['exists'] is None:
+                message = 'is not a local file'
+            elif not entry['exists']:
+                message = f'not found at \"{entry["file"]}\"'
+            elif entry['format'] not in LATEX_IMAGE_FORMATS:
+                message = f'has format {entry["format"]}, which pdflatex cannot include'
+            elif entry['bytes'] > IMAGE_MAX_BYTES:
+                message = f'is {entry["bytes"] / (1 << 20):.1f}MB'
+            elif entry['width'] and entry['width'] * entry['height'] > IMAGE_MAX_PIXELS:
+                message = f'is {entry["width"]}x{entry["height"]} pixels'
+            else:
+                continue
+            count += 1
+            print(WARN + f'{where} {message}')
+        print(INFO + f'{len(entries)} images, {count} problem(s)')
+        return count
+
+class IndexingConverter(Converter):
+    """Converter looking at the latex of every block together with its markdown line.
+
+    Labels, references and citations are recorded in index (an XrefIndex) and images in
+    assets (an AssetStage, which may also rewrite their paths); either may be None. Working
+    on the latex means they see exactly what latex will see (figures from images and <img>
+    tags, table and equation captions, raw latex). Code blocks are skipped. Use one
+    instance per document.
+    """
+    def __init__(self, config=Config(), index=None, assets=None):
+        super().__init__(config)
+        self.index = index
+        self.assets = assets
+        self.offset = 0
+
+    def start(self, md_lines):
+        # have_title删除开头的标题和空行后，块的行号要加上删除的行数
+        pulled = [0]
+        head = []
+
+        def counted():
+            for line in md_lines:
+                pulled[0] += 1
+                if len(head) < 2:
+                    head.append(line)
+                yield line
+
+        level1, rest = super().start(counted())
+        if not (self.config.have_title and head
+                and LEVEL1_PATTERN.match(head[0] if len(head) == 1 else head[0] + '\n')):
+            self.offset = 0
+            return level1, rest
+
+        def numbered():
+            first = True
+            for line in rest:
+                if first:
+                    self.offset = pulled[0] - 1
+                    first = False
+                yield line
+
+        return level1, numbered()
+
+    def convert_blocks(self, blocks, level1, env_stack, sep):
+        index = self.index
+        assets = self.assets
+        for blk in blocks:
+            if blk.kind == block.code:
+                sep = yield from super().convert_blocks((blk,), level1, env_stack, sep)
+                continue
+            chunks, sep = _drain(super().convert_blocks((blk,), level1, env_stack, sep))
+            tex = ''.join(chunks)
+            if assets is not None and '\\includegraphics' in tex:
+                chunks = [assets.rewrite(chunk, blk.lineno + self.offset) for chunk in chunks]
+            if index is not None and '\\' in tex:
+                if blk.kind in (block.table, block.equation):
+                    kind = blk.kind.name
+                elif env_stack[-1] == env.equation:
+                    kind = 'equation'
+                elif '\\includegraphics' in tex:
+                    kind = 'figure'
+                else:
+                    kind = 'label'
+                index.add(tex, blk.lineno + self.offset, kind)
+            yield from chunks
+        return sep
+
+def _drain(gen):
+    """Run a generator to completion; returns (yielded items, return value)."""
+    items = []
+    while True:
+        try:
+            items.append(next(gen))
+        except StopIteration as stop:
+            return items, stop.value
+
+def _scan_open(chunk, state):
+    """Track whether a code fence or $$ block is still open after the lines of chunk."""
+    for line in chunk.split('\n'):
+        if state == block.code:
+            if FENCE_PATTERN.match(line):
+                state = None
+        elif state == block.equation:
+            if line.count('$$') % 2:
+                state = None
+        elif FENCE_PATTERN.match(line):
+            state = block.code
+        elif line.count('$$') % 2:
+            state = block.equation
+    return state
+
+def split_segments(md_content):
+    """Split markdown at blank lines where iter_blocks is between blocks.
+
+    A blank line inside a code fence or a $$ block, or following a caption line, is not a
+    boundary. Each segment after the first starts right after the blank line that separates it.
+    """
+    segments = []
+    current = []
+    state = None
+    caption = False
+    for chunk in md_content.split('\n\n'):
+        current.append(chunk)
+        if state is not None or '```' in chunk or '$$' in chunk:
+            state = _scan_open(chunk, state)
+        # 标题行与其后的表格或公式之间只隔着空行
+        if chunk.strip('\n'):
+            chunk = chunk.rstrip('\n')
+            caption = CAPTION_PATTERN.match(chunk[chunk.rfind('\n') + 1:]) is not None
+        if state is None and not caption:
+            segments.append('\n\n'.join(current))
+            current = []
+    if current:
+        segments.append('\n\n'.join(current))
+    return segments
+
+def _document_level1(converter, md_content):
+    """Decide level1 once for a whole document; returns (level1, content without the title line if have_title)."""
+    level1 = LEVEL1_PATTERN.match(md_content) is not None
+    if converter.config.have_title and level1:
+        return False, TITLE_PATTERN.sub('', md_content, count=1)
+    return level1, md_content
+
+def _convert_segment(converter, segment, first, level1, env_state, sep):
+    """Convert one segment from the given incoming state; returns (latex, env_state, sep) after it."""
+    lines = segment.split('\n')
+    if not first:
+        lines.insert(0, '')
+    env_stack = list(env_state)
+    chunks, end_sep = _drain(converter.convert_blocks(converter.iter_blocks(lines), level1, env_stack, sep))
+    return ''.join(chunks), tuple(env_stack), end_sep
+
+class IncrementalConverter:
+    """Convert successive versions of one document, re-converting only the segments that changed.
+
+    Segments come from split_segments() and their latex is memoized together with the list and
+    environment state they start and end in, so an edit re-converts the edited segment plus any
+    later segment whose incoming state changed.
+    """
+    def __init__(self, converter, max_entries=100000):
+        self.converter = converter
+        self.max_entries = max_entries
+        self.memo = {}
+
+    def convert(self, md_content):
+        converter = self.converter
+        level1, md_content = _document_level1(converter, md_content)
+
+        memo = self.memo
+        used = {}
+        out = []
+        env_state = (env.document,)
+        sep = ''
+        for i, segment in enumerate(split_segments(md_content)):
+            key = (segment, i == 0, level1, env_state, sep)
+            result = memo.get(key)
+            if result is None:
+                result = _convert_segment(converter, segment, i == 0, level1, env_state, sep)
+            used[key] = result
+            text, env_state, sep = result
+            out.append(text)
+        out.extend(converter.close_envs(list(env_state), sep))
+
+        memo.update(used)
+        if len(memo) > self.max_entries:
+            self.memo = used
+        return ''.join(out)
+
+def _split_parts(segments, target):
+    """Join segments into parts of about target characters.
+
+    A part only ends where the pre-scan sees no open list (the last line is not a list item)
+    and no open latex math environment, so the next part most likely starts at the document
+    level. Fenced code, $$ blocks and captions never straddle segments.
+    """
+    parts = []
+    current = []
+    size = 0
+    math_depth = 0
+    for segment in segments:
+        current.append(segment)
+        size += len(segment) + 2
+        if '\\begin{' in segment or '\\end{' in segment:
+            for line in segment.split('\n'):
+                if MATH_BEGIN_PATTERN.match(line):
+                    math_depth += 1
+                elif MATH_END_PATTERN.match(line) and math_depth:
+                    math_depth -= 1
+        last = segment.rstrip('\n')
+        last = last[last.rfind('\n') + 1:]
+        in_list = last.startswith('- ') or LIST_NUM_PATTERN.match(last)
+        if size >= target and not math_depth and not in_list:
+            parts.append('\n\n'.join(current))
+            current = []
+            size = 0
+    if current:
+        parts.append('\n\n'.join(current))
+    return parts
+
+def _convert_part(config, part, first, level1):
+    # 假设每一部分都从文档顶层开始；第一部分之后，sep总是'\n'
+    return _convert_segment(get_converter(config), part, first, level1, (env.document,), '' if first else '\n')
+
+def convert_parallel(md_content, config=Config(), jobs=None, min_part_size=1 << 18):
+    """Convert one large document on a process pool, with the same output as Converter.convert.
+
+    The document is cut into parts at blank lines outside code, $$ blocks, lists and math
+    environments, and the parts are converted concurrently, each starting from the document
+    level. level1 is decided once for the whole document and shared by every part. The
+    parts are stitched in order; if a part actually starts in another state (e.g. a list
+    that the pre-scan missed), it is converted again from the real state.
+    """
+    converter = get_converter(config)
+    jobs = jobs or os.cpu_count() or 1
+    level1, content = _document_level1(converter, md_content)
+    parts = _split_parts(split_segments(content), max(min_part_size, len(content) // (jobs * 4)))
+    if jobs == 1 or len(parts) == 1:
+        return converter.convert(md_content)
+
+    out = []
+    env_state = (env.document,)
+    sep = ''
+    with ProcessPoolExecutor(min(jobs, len(parts))) as executor:
+        futures = [executor.submit(_convert_part, config, part, i == 0, level1) for i, part in enumerate(parts)]
+        for i, (part, future) in enumerate(zip(parts, futures)):
+            text, end_state, end_sep = future.result()
+            if env_state != (env.document,) or sep != ('' if i == 0 else '\n'):
+                # 实际的起始状态与假设不同，按实际状态重新转换这一部分
+                text, end_state, end_sep = _convert_segment(converter, part, i == 0, level1, env_state, sep)
+            out.append(text)
+            env_state, sep = end_state, end_sep
+    out.extend(converter.close_envs(list(env_state), sep))
+    return ''.join(out)
+
+def md_to_tex_iter(md_lines, args):
+    """Convert an iterable of markdown lines (with their newlines, e.g. an open file) to latex, yielding chunks.
+
+    ''.join(md_to_tex_iter(f, args)) equals md_to_tex(f.read(), args).
+    """
+    return get_converter(Config.from_args(args)).iter_convert(md_lines)
+
+def md_to_tex(md_content, args):
+    return get_converter(Config.from_args(args)).convert(md_content)
+
+def _convert_fragments(config, md_contents):
+    return list(get_converter(config).convert_many(md_contents))
+
+def convert_batch(md_contents, args, jobs=1):
+    """Convert many markdown strings, giving the same results as md_to_tex on each of them.
+
+    The options are read once for the whole batch. With jobs > 1 the strings are converted
+    in chunks on a process pool.
+    """
+    config = Config.from_args(args)
+    md_contents = list(md_contents)
+    if jobs <= 1 or len(md_contents) < 2:
+        return _convert_fragments(config, md_contents)
+    # 每个进程分到若干块，减少调度和进程间通信的次数
+    size = -(-len(md_contents) // (jobs * 4))
+    chunks = [md_contents[i:i + size] for i in range(0, len(md_contents), size)]
+    with ProcessPoolExecutor(jobs) as executor:
+        return [tex for part in executor.map(_convert_fragments, itertools.repeat(config), chunks) for tex in part]
+
+TEMPLATE_BEGIN = '% ----- begin md -----'
+TEMPLATE_END = '% ----- end md -----'
+# 模板中的其他插入位置，如 % ----- preamble md -----
+TEMPLATE_SLOT_PATTERN = re.compile(r'^% ----- (\w+) md -----$', re.MULTILINE)
+USEPACKAGE_PATTERN = re.compile(r'\\usepackage\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}')
+TEX_COMMENT_PATTERN = re.compile(r'(?<!\\)%.*')
+
+# 转换结果可能用到的宏包，以及表明用到了该宏包的内容
+PACKAGE_MARKERS = {
+    'amsmath': ('\\begin{align*}',),
+    'booktabs': ('\\toprule',),
+    'float': (']{H}', '}[H]'),
+    'graphicx': ('\\includegraphics',),
+    'hyperref': ('\\href{',),
+    'longtable': ('\\begin{longtable}',),
+    'minted': ('\\begin{minted}', '\\mintinline'),
+    'listings': ('\\begin{lstlisting}',),
+    'xcolor': ('\\textcolor{',),
+}
+
+def needed_packages(chunks):
+    """Names of the packages in PACKAGE_MARKERS that the converted chunks use."""
+    missing = dict(PACKAGE_MARKERS)
+    found = []
+    for chunk in chunks:
+        for package, markers in list(missing.items()):
+            if any(marker in chunk for marker in markers):
+                found.append(package)
+                del missing[package]
+        if not missing:
+            break
+    return sorted(found)
+
+def _preamble_slot(template, body):
+    packages = [p for p in needed_packages(body) if p not in template.packages]
+    return ''.join(f'\n\\usepackage{{{p}}}' for p in packages)
+
+# 插入位置的名称 -> 根据转换结果生成插入内容的函数
+TEMPLATE_SLOTS = {
+    'preamble': _preamble_slot,
+}
+
+class Template:
+    """A template compiled once into the text before and after the converted body.
+
+    Besides the begin/end md markers, a template may contain slot lines such as
+    ``% ----- preamble md -----``, which are filled from the converted body; the preamble
+    slot receives \\usepackage lines for packages the body needs and the template lacks.
+    Without a template the prefix and suffix are empty.
+    """
+    def __init__(self, text=None):
+        if text is None:
+            self.prefix, self.suffix = '', ''
         else:
-            if env_stack[-1] == env.enumerate:
-                # 删除tex_content最后一个换行符
-                tex_content = tex_content[:-1]
-                tex_content += '\\end{enumerate}\n\n'
-                env_stack.pop()
-        
-        # 为每一段添加\par
-        # if not tex_line.startswith('\\') and env_stack[-1] not in [env.itemize, env.enumerate, env.table]:
-        #     tex_line = '\\par ' + tex_line
+            begin_index = text.find(TEMPLATE_BEGIN) + len(TEMPLATE_BEGIN)
+            end_index = text.find(TEMPLATE_END)
+            self.prefix, self.suffix = text[:begin_index] + '\n', text[end_index:]
+        # 切分后奇数位置为插入位置的名称
+        self.prefix_parts = TEMPLATE_SLOT_PATTERN.split(self.prefix)
+        self.suffix_parts = TEMPLATE_SLOT_PATTERN.split(self.suffix)
+        self.slots = [name for name in self.prefix_parts[1::2] + self.suffix_parts[1::2] if name in TEMPLATE_SLOTS]
+        self.packages = {name.strip() for names in USEPACKAGE_PATTERN.findall(TEX_COMMENT_PATTERN.sub('', text or ''))
+                         for name in names.split(',')}
 
-        tex_content += tex_line + '\n'
-    
-    # 关闭所有未关闭的环境
-    while len(env_stack) > 1:
-        if env_stack[-1] == env.itemize:
-            tex_content += '\\end{itemize}\n'
-        elif env_stack[-1] == env.enumerate:
-            tex_content += '\\end{enumerate}\n'
-        env_stack.pop()
+    def _render(self, parts, filled):
+        parts = parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = f'% ----- {parts[i]} md -----' + filled.get(parts[i], '')
+        return ''.join(parts)
+
+    def write(self, f, chunks):
+        """Write prefix, body chunks and suffix to f; the body is only buffered when a slot needs it."""
+        if not self.slots:
+            f.write(self.prefix)
+            f.writelines(chunks)
+            f.write(self.suffix)
+            return
+        body = list(chunks)
+        filled = {name: TEMPLATE_SLOTS[name](self, body) for name in self.slots}
+        f.write(self._render(self.prefix_parts, filled))
+        f.writelines(body)
+        f.write(self._render(self.suffix_parts, filled))
+
+_templates = {}
+
+def load_template(path):
+    """The compiled Template for path, read again only when the file changes."""
+    mtime = os.stat(path).st_mtime_ns
+    cached = _templates.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = _templates[path] = (mtime, Template(f.read()))
+    return cached[1]
+
+SUFFIX_POLICIES = ('increment', 'overwrite', 'error')
+
+class TexFileNamer:
+    """Pick output file names according to the suffix policy.
+
+    Each directory is listed once; existing "name (n).tex" files are indexed so the next
+    free suffix is found without probing the file system. With the increment policy the
+    chosen name is created exclusively, so concurrent runs never end up on the same file;
+    resolve a name right before writing it, and discard() it if the conversion fails.
+    """
+
+    def __init__(self, policy='increment'):
+        self.policy = policy
+        self._index = {}    # 目录 -> 已存在的文件名
+        self._claimed = set()
+
+    def _names(self, directory):
+        if directory not in self._index:
+            try:
+                self._index[directory] = set(os.listdir(directory or '.'))
+            except FileNotFoundError:
+                self._index[directory] = set()
+        return self._index[directory]
+
+    def _claim(self, tex_file):
+        """Create tex_file exclusively; False if somebody else already has it."""
+        try:
+            with open(tex_file, 'x', encoding='utf-8'):
+                pass
+        except FileExistsError:
+            return False
+        self._claimed.add(tex_file)
+        return True
+
+    def discard(self, tex_file):
+        """Delete tex_file if resolve created it, so a failed conversion leaves no empty file behind."""
+        if tex_file not in self._claimed:
+            return
+        self._claimed.remove(tex_file)
+        directory, name = os.path.split(tex_file)
+        self._names(directory).discard(name)
+        try:
+            os.remove(tex_file)
+        except FileNotFoundError:
+            pass
+
+    def resolve(self, tex_file):
+        """The file name to write tex_file to; raises FileExistsError if it exists under the error policy."""
+        if self.policy == 'overwrite':
+            return tex_file
+        directory, name = os.path.split(tex_file)
+        names = self._names(directory)
+        if name not in names:
+            if self.policy == 'error':
+                return tex_file
+            os.makedirs(directory or '.', exist_ok=True)
+            if self._claim(tex_file):
+                names.add(name)
+                return tex_file
+        if self.policy == 'error':
+            raise FileExistsError(f'File \"{tex_file}\" already exists, use -o or --suffix-policy to allow overwriting')
+
+        print(f'File \"{tex_file}\" already exists, we add a suffix to the file name')
+        stem, ext = os.path.splitext(name)
+        suffix = re.compile(re.escape(stem) + r' \((\d+)\)' + re.escape(ext))
+        used = {int(m.group(1)) for m in map(suffix.fullmatch, names) if m}
+        i = 1
+        while True:
+            while i in used:
+                i += 1
+            candidate = f'{stem} ({i}){ext}'
+            names.add(candidate)
+            if self._claim(os.path.join(directory, candidate)):
+                return os.path.join(directory, candidate)
+            # 被其他进程抢先创建了，继续找下一个
+            used.add(i)
+
+@functools.lru_cache(maxsize=None)
+def _source_digest():
+    # 转换代码本身变化时缓存同样失效
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+class ConversionCache:
+    """On-disk cache of converted .tex files, keyed by a hash of the markdown, the options and the template.
+
+    Once the cache grows past max_bytes, the least recently used entries are evicted by prune().
+    """
+    def __init__(self, cache_dir, max_bytes=256 << 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stored = 0     # 上次prune之后写入的条目数
+
+    def key(self, md_file, config, template):
+        h = hashlib.sha256(_source_digest())
+        h.update(repr(config).encode('utf-8'))
+        for part in (template.prefix, template.suffix):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        with open(md_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.tex')
+
+    def fetch(self, key, tex_file):
+        """Copy the cached output to tex_file; returns False on a miss."""
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, tex_file)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, tex_file):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(tex_file, tmp_path)
+        os.replace(tmp_path, path)
+        self.stored += 1
+
+    def prune(self, stored=0):
+        """Delete least recently used entries until the cache fits in max_bytes.
+
+        This stats every file in the cache, so it does nothing unless entries were stored
+        since the last prune, by this object or (stored) by other processes. Block memo
+        files are only written while converting a file whose output is then stored.
+        """
+        if not self.stored and not stored:
+            return
+        self.stored = 0
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                # 其他进程正在写入的临时文件不能删除，写完后os.replace会用到它
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class BlockMemo:
+    """Converted table and equation blocks, keyed by a hash of the block text and the options.
+
+    A block is memoized with its final latex (rendering and inline rules), which only
+    depends on the block itself when it starts at the document level (not inside a list).
+    The most recently used max_entries blocks are kept in memory. With store_dir, blocks
+    of at least disk_min_chars characters are also written there, one file per block, so
+    other processes (batch workers, later runs) can read them instead of converting again;
+    smaller blocks convert faster than a file can be read. The conversion cache prunes
+    them together with the .tex files.
+    """
+    def __init__(self, max_entries=4096, store_dir=None, disk_min_chars=4096):
+        self.max_entries = max_entries
+        self.store_dir = store_dir
+        self.disk_min_chars = disk_min_chars
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def counts(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def _load(self, key):
+        path = os.path.join(self.store_dir, key[:2], key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = tuple(json.load(f))
+            # 与ConversionCache一样，修改时间表示最近一次使用，prune按它淘汰
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        self.disk_hits += 1
+        return value
+
+    def _store(self, key, value):
+        path = os.path.join(self.store_dir, key[:2], key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def convert_blocks(self, convert_blocks, options, blocks, level1, env_stack, sep):
+        """convert_blocks of a Converter, with tables and equations taken from the memo when possible."""
+        entries = self.entries
+        for memoized, group in itertools.groupby(blocks, lambda blk: blk.kind in (block.table, block.equation)):
+            if not memoized:
+                sep = yield from convert_blocks(group, level1, env_stack, sep)
+                continue
+            for blk in group:
+                if len(env_stack) > 1:
+                    sep = yield from convert_blocks((blk,), level1, env_stack, sep)
+                    continue
+                text = '\n'.join(blk.lines)
+                on_disk = self.store_dir is not None and len(text) >= self.disk_min_chars
+                h = hashlib.blake2b(f'{options}{level1}{sep!r}'.encode('utf-8'), digest_size=16)
+                h.update(text.encode('utf-8'))
+                key = h.hexdigest()
+                value = entries.get(key)
+                if value is not None:
+                    self.hits += 1
+                    entries.move_to_end(key)
+                elif on_disk:
+                    value = self._load(key)
+                if value is None:
+                    self.misses += 1
+                    chunks, end_sep = _drain(convert_blocks((blk,), level1, env_stack, sep))
+                    value = (''.join(chunks), end_sep)
+                    if len(env_stack) > 1:
+                        # 块结束时仍有未关闭的环境，结果与之后的内容有关，不能复用
+                        yield value[0]
+                        sep = end_sep
+                        continue
+                    if on_disk:
+                        self._store(key, value)
+                entries[key] = value
+                if len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+                tex, sep = value
+                yield tex
+        return sep
+
+    def install(self, converter):
+        """A copy of converter that converts its tables and equations through this memo."""
+        converter = copy.copy(converter)
+        # 与ConversionCache一样加上代码本身的哈希，升级后磁盘上旧的结果不再使用
+        options = repr(converter.config) + _source_digest().hex()
+        converter.convert_blocks = functools.partial(self.convert_blocks, converter.convert_blocks, options)
+        return converter
+
+def open_block_memo(args):
+    if args.no_cache:
+        return BlockMemo(args.block_memo_size)
+    return BlockMemo(args.block_memo_size, os.path.join(args.cache_dir, 'blocks'))
+
+def _memo_summary(counts):
+    return (f'block memo: {counts["hits"] + counts["disk_hits"]} hits ({counts["disk_hits"]} from disk), '
+            f'{counts["misses"]} misses')
+
+def write_tex(converter, md_file, tex_file, template, cache=None, jobs=1):
+    """Convert md_file into tex_file; returns True if the output was taken from the cache.
+
+    With jobs > 1 the file is read whole and converted by convert_parallel; otherwise it is
+    streamed.
+    """
+    if cache is not None:
+        key = cache.key(md_file, converter.config, template)
+        if cache.fetch(key, tex_file):
+            return True
+    with open(md_file, 'r', encoding='utf-8') as f_md, open(tex_file, 'w', encoding='utf-8') as f:
+        if jobs > 1:
+            template.write(f, [convert_parallel(f_md.read(), converter.config, jobs)])
+        else:
+            # 边转换边写入，不在内存中拼接整个文档
+            template.write(f, converter.iter_convert(f_md))
+    if cache is not None:
+        cache.store(key, tex_file)
+    return False
+
+def open_cache(args):
+    if args.no_cache:
+        return None
+    return ConversionCache(args.cache_dir, args.cache_size << 20)
+
+def is_batch_input(md_file):
+    # 存在的文件即使名字中有[、?、*也按单个文件处理
+    if os.path.isfile(md_file):
+        return False
+    return os.path.isdir(md_file) or any(c in md_file for c in '*?[')
 
-    return tex_content
+def collect_md_files(md_file):
+    """Expand a directory (recursively) or a glob pattern into (root, sorted markdown files)."""
+    if os.path.isdir(md_file):
+        files = glob.glob(os.path.join(glob.escape(md_file), '**', '*.md'), recursive=True)
+        return md_file, sorted(files)
+    files = sorted(f for f in glob.glob(md_file, recursive=True) if os.path.isfile(f))
+    if not files:
+        return '.', []
+    return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files]), files
+
+def batch_tex_file(md_file, root, out_dir):
+    tex_file = os.path.splitext(md_file)[0] + '.tex'
+    if out_dir is not None:
+        # 在输出目录中保持原有的目录结构
+        tex_file = os.path.join(out_dir, os.path.relpath(os.path.abspath(tex_file), root))
+    return tex_file
+
+_batch_state = {}
+
+def _init_batch_worker(config, template, cache, memo, suffix_policy):
+    _batch_state['converter'] = memo.install(get_converter(config))
+    _batch_state['template'] = template
+    _batch_state['cache'] = cache
+    _batch_state['memo'] = memo
+    _batch_state['namer'] = TexFileNamer(suffix_policy)
+
+def _batch_job(md_file, tex_file):
+    start = time.perf_counter()
+    cached = False
+    before = _batch_state['memo'].counts()
+    namer = _batch_state['namer']
+    error = 'interrupted'
+    try:
+        os.makedirs(os.path.dirname(tex_file) or '.', exist_ok=True)
+        # 写入前才确定文件名，失败或被中断时删除新建的文件，下次运行不会绕开它编号
+        tex_file = namer.resolve(tex_file)
+        cached = write_tex(_batch_state['converter'], md_file, tex_file, _batch_state['template'], _batch_state['cache'])
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        if error is not None:
+            namer.discard(tex_file)
+    # 每个进程有自己的计数，只返回这个文件的增量
+    memo = {name: count - before[name] for name, count in _batch_state['memo'].counts().items()}
+    return md_file, tex_file, time.perf_counter() - start, cached, error, memo
+
+def batch_convert(args):
+    """Convert every markdown file under a directory or glob, in parallel with --jobs processes."""
+    root, md_files = collect_md_files(args.md_file)
+    if not md_files:
+        print(ERROR + f'No markdown files found for \"{args.md_file}\"')
+        exit(1)
+    config = Config.from_args(args)
+    # 模板只读取一次
+    template = Template() if args.template is None else load_template(args.template)
+    cache = open_cache(args)
+    memo = open_block_memo(args)
+
+    jobs = [(md_file, batch_tex_file(md_file, root, args.tex_file)) for md_file in md_files]
+
+    start = time.perf_counter()
+    if args.jobs == 1:
+        _init_batch_worker(config, template, cache, memo, args.suffix_policy)
+        results = (_batch_job(*job) for job in jobs)
+        results = _report_batch(results)
+    else:
+        with ProcessPoolExecutor(args.jobs, initializer=_init_batch_worker, initargs=(config, template, cache, memo, args.suffix_policy)) as executor:
+            futures = [executor.submit(_batch_job, *job) for job in jobs]
+            results = _report_batch(f.result() for f in as_completed(futures))
+    wall = time.perf_counter() - start
+
+    done, cached, failed, cpu, memo = results
+    if cache is not None:
+        # 写入缓存的是各个工作进程，没有命中缓存并且成功的文件都写入了
+        cache.prune(done - cached)
+
+    print(INFO + f'{done} converted ({cached} from cache), {failed} failed, {cpu:.2f}s conversion time in {wall:.2f}s wall time '
+          f'({done / wall if wall else 0:.1f} files/s, {args.jobs} jobs)')
+    print(INFO + _memo_summary(memo))
+    if failed:
+        exit(1)
+
+def _report_batch(results):
+    done, cached, failed, cpu = 0, 0, 0, 0.0
+    memo = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+    for md_file, tex_file, elapsed, hit, error, memo_counts in results:
+        cpu += elapsed
+        for name, count in memo_counts.items():
+            memo[name] += count
+        if error is None:
+            done += 1
+            cached += hit
+            print(f'{elapsed:8.3f}s  \"{md_file}\" -> \"{tex_file}\"' + (' (cached)' if hit else ''))
+        else:
+            failed += 1
+            print(ERROR + f'\"{md_file}\": {error}')
+    return done, cached, failed, cpu, memo
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _watched_md_files(args):
+    if is_batch_input(args.md_file):
+        return collect_md_files(args.md_file)
+    return None, [args.md_file]
+
+def watch(args):
+    """Poll the markdown files and the template, re-converting only what changed.
+
+    Bursts of saves are coalesced: a change is converted once the files have stayed
+    unchanged for --debounce seconds. A template change re-converts every file.
+    """
+    batch = is_batch_input(args.md_file)
+    # 常驻运行时没有修改过的表格和公式直接从内存中取出
+    converter = open_block_memo(args).install(get_converter(Config.from_args(args)))
+    cache = open_cache(args)
+    template = Template()
+    namer = TexFileNamer(args.suffix_policy)
+    outputs = {}        # md文件 -> tex文件，只在第一次出现时确定文件名
+    seen = {}           # 路径 -> (mtime, size)
+    pending = set()
+    last_change = 0.0
+
+    def output_for(md_file, root):
+        if md_file not in outputs:
+            if batch:
+                tex_file = batch_tex_file(md_file, root, args.tex_file)
+                os.makedirs(os.path.dirname(tex_file) or '.', exist_ok=True)
+            else:
+                tex_file = args.tex_file or args.md_file.replace('.md', '.tex')
+            outputs[md_file] = namer.resolve(tex_file)
+        return outputs[md_file]
+
+    def poll():
+        root, md_files = _watched_md_files(args)
+        changed = set()
+        for path in md_files + ([args.template] if args.template is not None else []):
+            key = _stat_key(path)
+            if key is not None and seen.get(path) != key:
+                seen[path] = key
+                changed.add(path)
+        return root, md_files, changed
+
+    def convert(root, md_files, changed):
+        nonlocal template
+        if args.template is not None and args.template in changed:
+            template = load_template(args.template)
+            changed = set(md_files)
+        for md_file in sorted(changed & set(md_files)):
+            start = time.perf_counter()
+            try:
+                tex_file = output_for(md_file, root)
+                cached = write_tex(converter, md_file, tex_file, template, cache)
+            except Exception as e:
+                print(ERROR + f'\"{md_file}\": {type(e).__name__}: {e}')
+                continue
+            print(f'{time.perf_counter() - start:8.3f}s  \"{md_file}\" -> \"{tex_file}\"' + (' (cached)' if cached else ''))
+        if cache is not None:
+            cache.prune()
+
+    root, md_files, changed = poll()
+    if not md_files:
+        print(WARN + f'No markdown files found for \"{args.md_file}\" yet')
+    convert(root, md_files, changed)
+    print(INFO + f'Watching \"{args.md_file}\"' + (f' and \"{args.template}\"' if args.template else '') + ', press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            root, md_files, changed = poll()
+            now = time.monotonic()
+            if changed:
+                pending |= changed
+                last_change = now
+            elif pending and now - last_change >= args.debounce:
+                convert(root, md_files, pending)
+                pending = set()
+    except KeyboardInterrupt:
+        print(INFO + 'Stopped watching')
+
+# 守护进程协议：请求为4字节大端长度加UTF-8 JSON {"markdown": ..., "options": {...}, "template": 路径}，
+# 响应为若干帧（1字节类型加4字节长度）：b'D'为latex片段，b'E'为错误信息，b'Z'表示结束
+REQUEST_HEADER = struct.Struct('>I')
+FRAME_HEADER = struct.Struct('>cI')
+
+class _FrameWriter:
+    """File-like object sending what is written as latex frames of about size characters."""
+    def __init__(self, wfile, size=1 << 16):
+        self.wfile = wfile
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def flush(self):
+        if self.parts:
+            data = ''.join(self.parts).encode('utf-8')
+            self.wfile.write(FRAME_HEADER.pack(b'D', len(data)) + data)
+            self.parts = []
+            self.length = 0
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Serve conversion requests on one connection until the client closes it."""
+    wbufsize = 1 << 16
+
+    def handle(self):
+        rfile, wfile = self.rfile, self.wfile
+        while True:
+            header = rfile.read(REQUEST_HEADER.size)
+            if len(header) < REQUEST_HEADER.size:
+                return
+            body = rfile.read(REQUEST_HEADER.unpack(header)[0])
+            out = _FrameWriter(wfile)
+            try:
+                request = json.loads(body)
+                converter = get_converter(Config(**request.get('options', {})))
+                template = load_template(request['template']) if request.get('template') else Template()
+                template.write(out, converter._iter_convert(iter_lines(request['markdown'])))
+                out.flush()
+            except Exception as e:
+                message = f'{type(e).__name__}: {e}'.encode('utf-8')
+                wfile.write(FRAME_HEADER.pack(b'E', len(message)) + message)
+            wfile.write(FRAME_HEADER.pack(b'Z', 0))
+            wfile.flush()
+
+class ConversionDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def default_socket():
+    # 不能放在缓存目录中，否则会被ConversionCache.prune当作缓存删除；与md2tex_client.py中的相同
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'md2tex.sock')
+    return os.path.join(tempfile.gettempdir(), f'md2tex-{os.getuid()}.sock')
+
+def serve_daemon(path):
+    """Listen on the Unix socket path until interrupted, keeping converters and templates warm."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if os.path.exists(path):
+        # 可能是上次没有正常退出留下的socket文件，仍有守护进程在监听时不再启动
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            print(ERROR + f'A daemon is already listening on \"{path}\"')
+            return
+        finally:
+            probe.close()
+    get_converter(Config())
+    # 被终止（如make结束时kill）时同样删除socket文件
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with ConversionDaemon(path, DaemonHandler) as server:
+        print(INFO + f'Listening on \"{path}\"')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(INFO + 'Stopped serving')
+        finally:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
 def main():
     args = arg_parser()
-    with open(args.md_file, 'r', encoding='utf-8') as f:
-        md_content = f.read()
-    tex_content = md_to_tex(md_content, args)
+    if args.serve is not None:
+        serve_daemon(args.serve or default_socket())
+        return
+    if args.watch:
+        watch(args)
+        return
+    if is_batch_input(args.md_file):
+        if args.profile is not None:
+            print(WARN + '--profile only works for a single markdown file, ignored in batch mode')
+        if args.xref is not None:
+            print(WARN + '--xref only works for a single markdown file, ignored in batch mode')
+        if args.assets is not None or args.rewrite_images:
+            print(WARN + '--assets and --rewrite-images only work for a single markdown file, ignored in batch mode')
+        batch_convert(args)
+        return
+    template = Template()
     if args.template is not None:
-        with open(args.template, 'r', encoding='utf-8') as f:
-            template_content = f.read()
-        begin_marker = r'% ----- begin md -----'
-        end_marker = r'% ----- end md -----'
-        begin_index = template_content.find(begin_marker) + len(begin_marker)
-        end_index = template_content.find(end_marker)
-        template_begin = template_content[:begin_index]
-        template_end = template_content[end_index:]
-        tex_content = template_begin + '\n' + tex_content + template_end
+        template = load_template(args.template)
     if args.tex_file is None:
         args.tex_file = args.md_file.replace('.md', '.tex')
-    if os.path.exists(args.tex_file) and not args.o:
-        print(f'File \"{args.tex_file}\" already exists, we add a suffix to the file name')
-        args.tex_file = args.tex_file.replace('.tex', ' (1).tex')
-        for i in range(1, 100000):
-            if os.path.exists(args.tex_file):
-                args.tex_file = args.tex_file.replace(f'({i}).tex', f'({i+1}).tex')
-            else:
-                break
-        if i == 100000:
-            print('\033[0;37;41m' + 'Error' + '\033[0m' + ' Too many files with the same name, please delete some files')
-            exit(1)
+    namer = TexFileNamer(args.suffix_policy)
+    try:
+        args.tex_file = namer.resolve(args.tex_file)
+    except FileExistsError as e:
+        print(ERROR + str(e))
+        exit(1)
+
+    # 分析、建立索引或检查图片时在本进程内转换，不拆分文件，也不使用缓存，否则命中的文件不会被转换
+    jobs = 1
+    memo = None
+    if args.profile is not None:
+        converter = ProfiledConverter(Config.from_args(args))
+        args.no_cache = True
+    elif args.xref is not None or args.assets is not None or args.rewrite_images:
+        index = XrefIndex() if args.xref is not None else None
+        assets = None
+        # 只有--xref时不检查图片
+        if args.assets is not None or args.rewrite_images:
+            tex_dir = os.path.dirname(os.path.abspath(args.tex_file)) if args.rewrite_images else None
+            assets = AssetStage(os.path.dirname(args.md_file), tex_dir)
+        converter = IndexingConverter(Config.from_args(args), index, assets)
+        args.no_cache = True
+    elif args.split and args.jobs > 1:
+        # 拆分后各部分在其他进程中转换，不经过本进程的块缓存
+        converter = get_converter(Config.from_args(args))
+        jobs = args.jobs
+    else:
+        memo = open_block_memo(args)
+        converter = memo.install(get_converter(Config.from_args(args)))
 
-    with open(args.tex_file, 'w', encoding='utf-8') as f:
-        f.write(tex_content)
-    print(f'Output file: \"{args.tex_file}\"')
+    cache = open_cache(args)
+    try:
+        cached = write_tex(converter, args.md_file, args.tex_file, template, cache, jobs)
+    except BaseException:
+        namer.discard(args.tex_file)
+        raise
+    if cache is not None:
+        cache.prune()
+    print(f'Output file: \"{args.tex_file}\"' + (' (cached)' if cached else ''))
+    if memo is not None and any(memo.counts().values()):
+        print(INFO + _memo_summary(memo.counts()))
+    if args.profile:
+        with open(args.profile, 'w', encoding='utf-8') as f:
+            json.dump(converter.profiler.to_json(), f, ensure_ascii=False, indent=2)
+        print(INFO + f'Profile written to \"{args.profile}\"')
+    elif args.profile is not None:
+        converter.profiler.report()
+    if args.xref is not None:
+        bib_keys = read_bib_keys(args.bib) if args.bib else None
+        xref_file = args.xref or os.path.splitext(args.tex_file)[0] + '.xref.json'
+        with open(xref_file, 'w', encoding='utf-8') as f:
+            json.dump(converter.index.to_json(bib_keys), f, ensure_ascii=False, separators=(',', ':'))
+        converter.index.report(bib_keys)
+        print(INFO + f'Cross-reference index written to \"{xref_file}\"')
+    if isinstance(converter, IndexingConverter) and converter.assets is not None:
+        entries = converter.assets.manifest()
+        if args.assets is not None:
+            assets_file = args.assets or os.path.splitext(args.tex_file)[0] + '.assets.json'
+            with open(assets_file, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False, separators=(',', ':'))
+            converter.assets.report(entries)
+            print(INFO + f'Image manifest written to \"{assets_file}\"')
 
 if __name__ == '__main__':
     start_time = time.time()
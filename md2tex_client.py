@@ -0,0 +1,124 @@
+"""Thin client of the md2tex daemon (python md2tex.py --serve).
+
+Sends one markdown file to the daemon over its Unix socket and writes the latex streamed
+back; when no daemon is running, the file is converted in this process instead. md2tex
+is only imported for that fallback, so with a daemon a call costs little more than the
+interpreter startup:
+
+    python md2tex.py --serve &
+    python md2tex_client.py --md-file report.md --tex-file report.tex --template template.tex
+    python md2tex_client.py --md-file - < report.md
+
+Protocol, for editor plugins talking to the socket directly: a request is a 4-byte
+big-endian length followed by that many bytes of UTF-8 JSON
+
+    {"markdown": "...", "options": {"figure_pos": "htbp"}, "template": "/abs/template.tex"}
+
+and the response is a sequence of frames, each a 1-byte kind and a 4-byte big-endian
+length followed by the payload: b'D' a piece of latex, b'E' an error message, and b'Z'
+(empty) ending the response. A connection can carry any number of requests.
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+REQUEST_HEADER = struct.Struct('>I')
+FRAME_HEADER = struct.Struct('>cI')
+
+class DaemonError(Exception):
+    """The daemon could not convert the request."""
+
+def default_socket():
+    # 与md2tex.py中的默认路径相同
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'md2tex.sock')
+    return os.path.join(tempfile.gettempdir(), f'md2tex-{os.getuid()}.sock')
+
+def connect(path):
+    """A connection to the daemon, or None when no daemon is listening on path."""
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+def request(sock, markdown, options=None, template=None):
+    """Send one request on sock, yielding the latex pieces as they arrive."""
+    body = json.dumps({'markdown': markdown, 'options': options or {}, 'template': template}).encode('utf-8')
+    sock.sendall(REQUEST_HEADER.pack(len(body)) + body)
+    rfile = sock.makefile('rb')
+    error = None
+    while True:
+        header = rfile.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            raise ConnectionError('the daemon closed the connection')
+        kind, length = FRAME_HEADER.unpack(header)
+        payload = rfile.read(length)
+        if kind == b'D':
+            yield payload.decode('utf-8')
+        elif kind == b'E':
+            error = payload.decode('utf-8')
+        else:
+            break
+    if error is not None:
+        raise DaemonError(error)
+
+def convert_local(markdown, options=None, template=None):
+    """The same conversion in this process, for when no daemon is running."""
+    import md2tex
+    converter = md2tex.get_converter(md2tex.Config(**(options or {})))
+    tmpl = md2tex.load_template(template) if template else md2tex.Template()
+    out = io.StringIO()
+    tmpl.write(out, [converter.convert(markdown)])
+    return [out.getvalue()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert markdown to latex with the md2tex daemon, or in process without one')
+    parser.add_argument('--md-file', type=str, default='report.md', help='The markdown file to be converted, - for stdin')
+    parser.add_argument('--tex-file', type=str, help='The output tex file, stdout if omitted')
+    parser.add_argument('--template', type=str, help='The template tex file')
+    parser.add_argument('--socket', type=str, default=default_socket(), help='Unix socket of the daemon')
+    parser.add_argument('--figure-pos', type=str, help='The position of the figure')
+    parser.add_argument('--table-pos', type=str, help='The position of the table')
+    parser.add_argument('--spaces', type=int, help='Number of spaces for each indentation level')
+    parser.add_argument('--code-type', type=str, help='How to handle code text')
+    parser.add_argument('--longtable-rows', type=int, help='Tables with more body rows become a longtable')
+    parser.add_argument('-have-title', action='store_true', default=None, help='Whether the document has a title')
+    args = parser.parse_args()
+
+    # 只发送指定了的选项，其余使用守护进程中Config的默认值
+    names = ('figure_pos', 'table_pos', 'spaces', 'code_type', 'longtable_rows', 'have_title')
+    options = {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+    template = os.path.abspath(args.template) if args.template else None
+    if args.md_file == '-':
+        markdown = sys.stdin.read()
+    else:
+        with open(args.md_file, 'r', encoding='utf-8') as f:
+            markdown = f.read()
+
+    sock = connect(args.socket)
+    if sock is None:
+        pieces = convert_local(markdown, options, template)
+    else:
+        with sock:
+            pieces = list(request(sock, markdown, options, template))
+    if args.tex_file is None:
+        sys.stdout.writelines(pieces)
+    else:
+        with open(args.tex_file, 'w', encoding='utf-8') as f:
+            f.writelines(pieces)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except DaemonError as e:
+        print(f'Error: {e}', file=sys.stderr)
+        sys.exit(1)
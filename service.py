@@ -0,0 +1,237 @@
+"""Asynchronous conversion service for md2tex.
+
+Requests wait in a bounded queue and are converted by worker processes that keep their
+converters warm between requests. A full queue is rejected right away (ServiceBusy)
+instead of piling up, and every request has a timeout; a request that times out or is
+cancelled while still queued is never converted, and one that is already being converted
+has its worker process killed and replaced, so a pathological document cannot hold a
+worker after its client has given up.
+
+The Gradio app submits to the service, and it can also be run as a local HTTP/JSON
+endpoint:
+
+    python service.py --port 8765 --workers 4
+
+    POST /convert  {"markdown": "...", "options": {"figure_pos": "htbp"}}
+                   -> 200 {"latex": "..."}, 400 bad request, 503 queue full, 504 timeout
+    GET  /health   -> 200 {"queued": 0, "running": 0, "done": 12, "busy": 0, "timeouts": 0, "restarts": 0}
+"""
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+
+from md2tex import INFO, Config, get_converter
+
+class ServiceBusy(Exception):
+    """The request queue is full."""
+
+def _init_worker():
+    # 预先建好默认选项的转换器，之后每种选项的转换器在进程内缓存
+    get_converter(Config())
+
+def _convert(md_content, config):
+    return get_converter(config).convert(md_content)
+
+def _new_worker():
+    pool = ProcessPoolExecutor(1, initializer=_init_worker)
+    # 立即启动进程，不让下一个请求等待进程启动
+    pool.submit(int)
+    return pool
+
+def _kill_worker(pool):
+    """Terminate the process of a one-process pool, even in the middle of a conversion."""
+    terminate = getattr(pool, 'terminate_workers', None)  # Python 3.14+
+    if terminate is not None:
+        terminate()
+        return
+    for process in list(pool._processes.values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+class ConversionService:
+    """Bounded queue of conversion requests served by warm worker processes.
+
+    Every worker is a one-process pool with its own dispatcher task. When a request times
+    out or is cancelled during its conversion, that process is killed and a new one started
+    (counted in stats['restarts']); the new process has to build its converters again.
+    """
+    def __init__(self, workers=None, queue_size=64, timeout=30.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.stats = {'done': 0, 'busy': 0, 'timeouts': 0, 'restarts': 0}
+        self._running = 0
+        self._queue = None
+        self._pools = []
+        self._dispatchers = []
+
+    async def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(self.queue_size)
+        # 每个分发任务有自己的进程，被放弃的转换只需要结束这一个进程
+        self._pools = [_new_worker() for _ in range(self.workers)]
+        self._dispatchers = [asyncio.create_task(self._dispatch(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        for pool in self._pools:
+            pool.shutdown(cancel_futures=True)
+        self._pools = []
+        self._queue = None
+
+    async def _dispatch(self, i):
+        loop = asyncio.get_running_loop()
+        while True:
+            md_content, config, future = await self._queue.get()
+            # 已经超时或被取消的请求直接跳过
+            if future.done():
+                continue
+            self._running += 1
+            try:
+                task = loop.run_in_executor(self._pools[i], _convert, md_content, config)
+                await asyncio.wait((task, future), return_when=asyncio.FIRST_COMPLETED)
+                if not task.done():
+                    # 请求在转换过程中超时或被取消，不再等待转换结束，换一个新进程
+                    task.cancel()
+                    _kill_worker(self._pools[i])
+                    self._pools[i] = _new_worker()
+                    self.stats['restarts'] += 1
+                elif task.exception() is not None:
+                    if not future.done():
+                        future.set_exception(task.exception())
+                elif not future.done():
+                    future.set_result(task.result())
+            finally:
+                self._running -= 1
+
+    async def convert(self, md_content, config=Config(), timeout=None):
+        """Convert md_content in a worker process.
+
+        Raises ServiceBusy when the queue is full and asyncio.TimeoutError when the result
+        is not ready within timeout seconds (the service default if None).
+        """
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((md_content, config, future))
+        except asyncio.QueueFull:
+            self.stats['busy'] += 1
+            raise ServiceBusy(f'{self.queue_size} requests are already waiting') from None
+        try:
+            # 超时或取消时future也会被取消，排队中的请求不会再被转换，转换中的请求会结束其进程
+            result = await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+        self.stats['done'] += 1
+        return result
+
+    def health(self):
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return {'queued': queued, 'running': self._running, **self.stats}
+
+def config_from_options(options):
+    """Build a Config from a JSON object of option names; unknown names raise ValueError."""
+    names = {f.name for f in fields(Config)}
+    unknown = set(options) - names
+    if unknown:
+        raise ValueError(f'unknown options: {", ".join(sorted(unknown))}')
+    return Config(**options)
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length) if length else b''
+    return method, path, body
+
+def _response(writer, status, reason, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+
+async def handle_http(service, reader, writer):
+    """Serve keep-alive HTTP/1.1 requests on one connection."""
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                _response(writer, 400, 'Bad Request', {'error': 'malformed request'})
+                break
+            if request is None:
+                break
+            method, path, body = request
+            if method == 'GET' and path == '/health':
+                _response(writer, 200, 'OK', service.health())
+            elif method == 'POST' and path == '/convert':
+                try:
+                    data = json.loads(body)
+                    config = config_from_options(data.get('options', {}))
+                    latex = await service.convert(data['markdown'], config, data.get('timeout'))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    _response(writer, 400, 'Bad Request', {'error': str(e)})
+                except ServiceBusy as e:
+                    _response(writer, 503, 'Service Unavailable', {'error': str(e)})
+                except asyncio.TimeoutError:
+                    _response(writer, 504, 'Gateway Timeout', {'error': 'conversion timed out'})
+                except Exception as e:
+                    _response(writer, 500, 'Internal Server Error', {'error': f'{type(e).__name__}: {e}'})
+                else:
+                    _response(writer, 200, 'OK', {'latex': latex})
+            else:
+                _response(writer, 404, 'Not Found', {'error': f'{method} {path}'})
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        # 服务关闭时取消空闲连接，正常结束即可
+        pass
+    finally:
+        writer.close()
+
+async def serve(service, host='127.0.0.1', port=8765):
+    """Start the HTTP/JSON endpoint; returns the asyncio server."""
+    await service.start()
+    return await asyncio.start_server(lambda r, w: handle_http(service, r, w), host, port)
+
+def main():
+    parser = argparse.ArgumentParser(description='md2tex conversion service with a local HTTP/JSON endpoint')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+    parser.add_argument('--queue-size', type=int, default=64, help='Requests that may wait before new ones are rejected')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Default per-request timeout in seconds')
+    args = parser.parse_args()
+
+    async def run():
+        service = ConversionService(args.workers, args.queue_size, args.timeout)
+        server = await serve(service, args.host, args.port)
+        print(INFO + f'Serving on http://{args.host}:{args.port} with {service.workers} workers')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await service.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()